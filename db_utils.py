@@ -1,47 +1,1599 @@
 import os
+import time
+import random
 import sqlite3
 import json
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import LifoQueue, Empty, Full
 from threading import Lock
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db')
 
-db_lock = Lock()
+# Connection tuning. WAL lets readers proceed while a writer commits, and
+# busy_timeout makes writers from other processes wait instead of failing.
+# SQLite's busy wait blocks the calling thread (and under gevent the whole hub),
+# so it is kept short; transaction() does the longer wait with plain sleeps.
+BUSY_TIMEOUT_MS = 100
+MMAP_SIZE = 256 * 1024 * 1024
+POOL_SIZE = 8
+
+# Maximum number of individually cached users per process.
+USER_CACHE_SIZE = 10000
+
+# User-ID sequence numbers reserved per round trip by allocate_user_ids.
+ID_BLOCK_SIZE = 16
+
+# Total seconds a write transaction waits for the lock held by another connection,
+# and the first back-off between attempts (doubled up to TX_RETRY_MAX_DELAY).
+TX_TIMEOUT = 5.0
+TX_RETRY_DELAY = 0.02
+TX_RETRY_MAX_DELAY = 0.25
+
+# How often modify_user re-reads and retries after a concurrent change.
+CONFLICT_RETRIES = 5
+
+# Schema version stored in PRAGMA user_version.
+# 0/1: legacy ``users(username, data)`` JSON blob table.
+# 2:   typed columns plus a JSON ``extra`` overflow column.
+# 3:   per-row ``version`` counter for optimistic concurrency checks.
+# 4:   user_id index and the ``user_id_seq`` allocator table.
+# 5:   (is_admin|owner, created_at, username) indexes matching the list page ordering.
+# 6:   ``users_fts`` trigram index for substring search on username/nickname.
+# 7:   append-only ``ledger`` table replacing ledger.json.
+# 8:   ``ledger_rollup`` revenue aggregates maintained by an insert trigger.
+# 9:   ``pending_apps`` counters of pending agent applications.
+# 10:  ``applications`` table; pending_apps maintained by its triggers.
+# 11:  ``jobs`` background job state and ``job_rejects`` per-row import errors.
+# 12:  ``bulk_accounts`` generated credentials per bulk-create batch.
+# 13:  ``users_changes`` counter bumped by users triggers, validating the user cache.
+# 14:  users_fts insert trigger skipped while bulk inserts index set-wise.
+# 15:  rollup periods only for times long enough to have them (rollups rebuilt).
+# 16:  ``jobs.pid`` of the process running the job, for stale-job recovery.
+SCHEMA_VERSION = 16
+
+
+class ConflictError(Exception):
+    """Raised when a row changed since it was read (optimistic version check failed)."""
+
+# Typed user columns, in table order (username is the primary key).
+USER_COLUMNS = (
+    'user_id', 'password', 'nickname', 'is_admin', 'is_agent', 'enabled',
+    'source', 'forsale', 'owner', 'product', 'price', 'created_at',
+    'last_login', 'ip_address', 'location', 'remark',
+)
+BOOL_COLUMNS = {'is_admin': False, 'is_agent': False, 'enabled': True, 'forsale': False}
+
+_USERS_DDL = '''
+CREATE TABLE IF NOT EXISTS users (
+    username   TEXT PRIMARY KEY,
+    user_id    TEXT,
+    password   TEXT,
+    nickname   TEXT,
+    is_admin   INTEGER NOT NULL DEFAULT 0,
+    is_agent   INTEGER NOT NULL DEFAULT 0,
+    enabled    INTEGER NOT NULL DEFAULT 1,
+    source     TEXT,
+    forsale    INTEGER NOT NULL DEFAULT 0,
+    owner      TEXT,
+    product    TEXT,
+    price      REAL,
+    created_at TEXT NOT NULL DEFAULT '',
+    last_login TEXT,
+    ip_address TEXT,
+    location   TEXT,
+    remark     TEXT,
+    extra      TEXT,
+    version    INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+_USERS_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_users_owner_created ON users (owner, created_at, username)',
+    'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_users_enabled ON users (enabled)',
+    'CREATE INDEX IF NOT EXISTS idx_users_source ON users (source)',
+    'CREATE INDEX IF NOT EXISTS idx_users_forsale ON users (forsale)',
+    'CREATE INDEX IF NOT EXISTS idx_users_user_id ON users (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_users_admin_created ON users (is_admin, created_at, username)',
+)
+
+# Auxiliary tables, created on every schema upgrade (all idempotent).
+# Sales ledger columns, in table order (id is the rowid).
+LEDGER_COLUMNS = ('time', 'role', 'admin', 'agent', 'product', 'price', 'count', 'revenue')
+
+_LEDGER_DDL = '''
+CREATE TABLE IF NOT EXISTS ledger (
+    id      INTEGER PRIMARY KEY,
+    time    TEXT NOT NULL DEFAULT '',
+    role    TEXT NOT NULL DEFAULT 'admin',
+    admin   TEXT,
+    agent   TEXT,
+    product TEXT,
+    price   REAL,
+    count   INTEGER,
+    revenue REAL,
+    extra   TEXT
+)
+'''
+
+# Agent bulk-account application columns, in table order (id is the primary key).
+APPLICATION_COLUMNS = ('agent', 'count', 'price', 'product', 'status', 'created_at')
+
+_APPLICATIONS_DDL = '''
+CREATE TABLE IF NOT EXISTS applications (
+    id         TEXT PRIMARY KEY,
+    agent      TEXT,
+    count      INTEGER,
+    price      REAL,
+    product    TEXT,
+    status     TEXT NOT NULL DEFAULT 'pending',
+    created_at TEXT NOT NULL DEFAULT '',
+    extra      TEXT
+)
+'''
+
+# Keep pending_apps (per agent, '' for none, '*' for all) in step with applications.
+_PENDING_INC = (
+    "INSERT INTO pending_apps (agent, pending) "
+    "SELECT a, 1 FROM (SELECT COALESCE(new.agent, '') AS a UNION ALL SELECT '*') "
+    "WHERE new.status = 'pending' ON CONFLICT (agent) DO UPDATE SET pending = pending + 1;"
+)
+_PENDING_DEC = (
+    "UPDATE pending_apps SET pending = pending - 1 "
+    "WHERE old.status = 'pending' AND agent IN (COALESCE(old.agent, ''), '*');"
+)
+_APPLICATIONS_TRIGGERS = (
+    f'CREATE TRIGGER IF NOT EXISTS applications_pending_ai AFTER INSERT ON applications '
+    f'BEGIN {_PENDING_INC} END',
+    f'CREATE TRIGGER IF NOT EXISTS applications_pending_ad AFTER DELETE ON applications '
+    f'BEGIN {_PENDING_DEC} END',
+    f'CREATE TRIGGER IF NOT EXISTS applications_pending_au AFTER UPDATE OF status, agent ON applications '
+    f'BEGIN {_PENDING_DEC} {_PENDING_INC} END',
+)
+
+# Background job columns, in table order (id is the primary key).
+JOB_COLUMNS = ('kind', 'owner', 'status', 'total', 'done', 'params', 'result', 'error',
+               'created_at', 'updated_at', 'pid')
+_JSON_JOB_COLUMNS = ('params', 'result')
+_ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+# A queued/running job whose updated_at heartbeat is older than this, or whose
+# process is gone, is marked failed when read (see fail_stale_jobs).
+JOB_STALE_SECONDS = 60
+
+_JOBS_DDL = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id         TEXT PRIMARY KEY,
+    kind       TEXT NOT NULL,
+    owner      TEXT,
+    status     TEXT NOT NULL DEFAULT 'queued',
+    total      INTEGER NOT NULL DEFAULT 0,
+    done       INTEGER NOT NULL DEFAULT 0,
+    params     TEXT,
+    result     TEXT,
+    error      TEXT,
+    created_at TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL DEFAULT '',
+    pid        INTEGER
+)
+'''
+
+# Revenue rollups: one row per (period, role, admin, agent, product) where period is
+# 'YYYY-MM-DD', 'YYYY-MM', 'YYYY' or '' (all time) and '*' in a dimension means "any".
+# Every ledger insert adds its revenue to all 4 x 2 x 2 x 2 combinations, so a
+# dashboard figure is a single primary-key lookup.
+_LEDGER_ROLLUP_DDL = '''
+CREATE TABLE IF NOT EXISTS ledger_rollup (
+    period  TEXT NOT NULL,
+    role    TEXT NOT NULL,
+    admin   TEXT NOT NULL,
+    agent   TEXT NOT NULL,
+    product TEXT NOT NULL,
+    revenue REAL NOT NULL DEFAULT 0,
+    records INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, role, admin, agent, product)
+) WITHOUT ROWID
+'''
+
+# Expands ledger row ``{r}`` into its rollup keys; pass ``src='ledger AS l,'`` to
+# aggregate the table. A period is only produced when ``time`` is long enough to
+# contain it, so a short or empty time cannot map several periods onto one key.
+_ROLLUP_CUBE = '''
+SELECT substr({r}.time, 1, p.n) AS period, {r}.role AS role,
+       CASE WHEN a.w THEN '*' ELSE COALESCE({r}.admin, '') END AS admin,
+       CASE WHEN g.w THEN '*' ELSE COALESCE({r}.agent, '') END AS agent,
+       CASE WHEN d.w THEN '*' ELSE COALESCE({r}.product, '') END AS product,
+       COALESCE({r}.revenue, 0) AS revenue
+FROM {src}
+     (SELECT 10 AS n UNION ALL SELECT 7 UNION ALL SELECT 4 UNION ALL SELECT 0) AS p,
+     (SELECT 0 AS w UNION ALL SELECT 1) AS a,
+     (SELECT 0 AS w UNION ALL SELECT 1) AS g,
+     (SELECT 0 AS w UNION ALL SELECT 1) AS d
+WHERE p.n = 0 OR length({r}.time) >= p.n
+'''
+
+_LEDGER_ROLLUP_TRIGGER = (
+    'CREATE TRIGGER IF NOT EXISTS ledger_rollup_ai AFTER INSERT ON ledger BEGIN '
+    'INSERT INTO ledger_rollup (period, role, admin, agent, product, revenue, records) '
+    'SELECT period, role, admin, agent, product, revenue, 1 FROM ('
+    + _ROLLUP_CUBE.format(r='new', src='') +
+    ') WHERE 1 ON CONFLICT (period, role, admin, agent, product) DO UPDATE SET '
+    'revenue = revenue + excluded.revenue, records = records + 1; END'
+)
+
+_AUX_DDL = (
+    # Last user_id suffix handed out per 14-digit timestamp.
+    'CREATE TABLE IF NOT EXISTS user_id_seq (stamp TEXT PRIMARY KEY, last INTEGER NOT NULL)',
+    _LEDGER_DDL,
+    'CREATE INDEX IF NOT EXISTS idx_ledger_role_time ON ledger (role, time)',
+    'CREATE INDEX IF NOT EXISTS idx_ledger_role_admin_time ON ledger (role, admin, time)',
+    'CREATE INDEX IF NOT EXISTS idx_ledger_role_product_time ON ledger (role, product, time)',
+    'CREATE INDEX IF NOT EXISTS idx_ledger_agent_time ON ledger (agent, time)',
+    _LEDGER_ROLLUP_DDL,
+    # Pending application counts per agent; agent '*' holds the overall total.
+    'CREATE TABLE IF NOT EXISTS pending_apps ('
+    'agent TEXT PRIMARY KEY, pending INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID',
+    _APPLICATIONS_DDL,
+    'CREATE INDEX IF NOT EXISTS idx_applications_status ON applications (status)',
+    'CREATE INDEX IF NOT EXISTS idx_applications_agent ON applications (agent)',
+    _JOBS_DDL,
+    'CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at)',
+    'CREATE TABLE IF NOT EXISTS job_rejects ('
+    'job_id TEXT NOT NULL, row INTEGER NOT NULL, username TEXT, reason TEXT, '
+    'PRIMARY KEY (job_id, row)) WITHOUT ROWID',
+    # Credentials handed out by a bulk create, in generation order, for paging and export.
+    'CREATE TABLE IF NOT EXISTS bulk_accounts ('
+    'batch_id TEXT NOT NULL, seq INTEGER NOT NULL, username TEXT NOT NULL, password TEXT, '
+    'PRIMARY KEY (batch_id, seq)) WITHOUT ROWID',
+    # Bumped on every update/delete of a user row; the user cache is valid while it
+    # is unchanged. Inserts need no bump: the cache only holds rows that existed.
+    'CREATE TABLE IF NOT EXISTS users_changes ('
+    'id INTEGER PRIMARY KEY CHECK (id = 0), n INTEGER NOT NULL DEFAULT 0)',
+    'INSERT OR IGNORE INTO users_changes (id, n) VALUES (0, 0)',
+    'CREATE TRIGGER IF NOT EXISTS users_changes_au AFTER UPDATE ON users BEGIN '
+    'UPDATE users_changes SET n = n + 1 WHERE id = 0; END',
+    'CREATE TRIGGER IF NOT EXISTS users_changes_ad AFTER DELETE ON users BEGIN '
+    'UPDATE users_changes SET n = n + 1 WHERE id = 0; END',
+)
+
+# FTS5 trigram index over users (external content), kept in sync by triggers.
+# Bulk inserts put a row in users_fts_defer for the duration of their transaction,
+# which turns the per-row insert trigger off, and index the new rows in one
+# statement instead (see _bulk_search_index).
+# Optional: skipped on SQLite builds without FTS5 or the trigram tokenizer (< 3.34).
+_USER_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, nickname, content='users', tokenize='trigram')",
+    'CREATE TABLE IF NOT EXISTS users_fts_defer (id INTEGER PRIMARY KEY CHECK (id = 0))',
+    'CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users '
+    'WHEN NOT EXISTS (SELECT 1 FROM users_fts_defer) BEGIN '
+    'INSERT INTO users_fts (rowid, username, nickname) '
+    'VALUES (new.rowid, new.username, new.nickname); END',
+    'CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN '
+    "INSERT INTO users_fts (users_fts, rowid, username, nickname) "
+    "VALUES ('delete', old.rowid, old.username, old.nickname); END",
+    'CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, nickname ON users BEGIN '
+    "INSERT INTO users_fts (users_fts, rowid, username, nickname) "
+    "VALUES ('delete', old.rowid, old.username, old.nickname); "
+    'INSERT INTO users_fts (rowid, username, nickname) '
+    'VALUES (new.rowid, new.username, new.nickname); END',
+)
+
+# Trigram queries need at least this many characters; shorter ones fall back to LIKE.
+SEARCH_MIN_CHARS = 3
+
+_SELECT_USER = 'SELECT username, {}, extra FROM users'.format(', '.join(USER_COLUMNS))
+_INSERT_USER = 'INSERT INTO users (username, {}, extra) VALUES ({})'.format(
+    ', '.join(USER_COLUMNS), ', '.join('?' * (len(USER_COLUMNS) + 2))
+)
+_UPSERT_USER = _INSERT_USER + ' ON CONFLICT(username) DO UPDATE SET {}, version = users.version + 1'.format(
+    ', '.join(f'{c} = excluded.{c}' for c in USER_COLUMNS + ('extra',))
+)
+_UPDATE_USER = 'UPDATE users SET {}, version = version + 1 WHERE username = ?'.format(
+    ', '.join(f'{c} = ?' for c in USER_COLUMNS + ('extra',))
+)
+
+
+def _user_to_row(username: str, info: dict) -> tuple:
+    """Split a user dict into typed column values plus the JSON overflow."""
+    if not isinstance(info, dict):
+        info = {}
+    values = []
+    for col in USER_COLUMNS:
+        value = info.get(col)
+        if col in BOOL_COLUMNS:
+            value = int(bool(info.get(col, BOOL_COLUMNS[col])))
+        elif col == 'created_at':
+            value = value or ''
+        elif value is not None and col != 'price':
+            value = str(value)
+        values.append(value)
+    extra = {k: v for k, v in info.items() if k not in USER_COLUMNS}
+    return (username, *values, json.dumps(extra, ensure_ascii=False) if extra else None)
+
+
+def _row_to_user(row) -> tuple:
+    """Rebuild ``(username, info)`` from a row selected with ``_SELECT_USER``."""
+    username, *values, extra = row
+    info = {}
+    if extra:
+        try:
+            info.update(json.loads(extra))
+        except Exception:
+            pass
+    for col, value in zip(USER_COLUMNS, values):
+        if col in BOOL_COLUMNS:
+            info[col] = bool(value)
+        elif value is not None:
+            info[col] = value
+    return username, info
+
+
+def _migrate_legacy(conn) -> None:
+    """Move rows from the legacy JSON blob table into the typed schema."""
+    conn.execute('ALTER TABLE users RENAME TO users_legacy')
+    conn.execute(_USERS_DDL)
+    rows = []
+    for username, data in conn.execute('SELECT username, data FROM users_legacy'):
+        try:
+            info = json.loads(data)
+        except Exception:
+            info = {}
+        rows.append(_user_to_row(username, info))
+    conn.executemany(_UPSERT_USER, rows)
+    conn.execute('DROP TABLE users_legacy')
+
+
+_pool = None
+_pool_key = None
+_pool_lock = Lock()
+_schema_ready = None
+_search_ready = False
+
+
+def _open_connection():
+    """Open a new connection to DB_PATH with the tuned pragmas applied."""
+    conn = sqlite3.connect(
+        DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+    )
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def _get_pool() -> LifoQueue:
+    """Return this process's connection pool, rebuilding it after fork or a DB_PATH change."""
+    global _pool, _pool_key
+    key = (os.getpid(), DB_PATH)
+    if _pool_key != key:
+        with _pool_lock:
+            if _pool_key != key:
+                _pool = LifoQueue(maxsize=POOL_SIZE)
+                _pool_key = key
+    return _pool
+
+
+@contextmanager
+def get_connection():
+    """
+    Borrow a pooled connection for the current thread or greenlet.
+    Commits on success, rolls back on error and returns the connection to the pool.
+    """
+    pool = _get_pool()
+    try:
+        conn = pool.get_nowait()
+    except Empty:
+        conn = _open_connection()
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            pool.put_nowait(conn)
+        except Full:
+            conn.close()
+
+
+def _ensure_schema() -> None:
+    """Run init_db once per process and database path."""
+    if _schema_ready != (os.getpid(), DB_PATH):
+        init_db()
+
+
+def _is_busy(exc: Exception) -> bool:
+    """Return True if ``exc`` is SQLITE_BUSY / SQLITE_LOCKED from another connection."""
+    name = getattr(exc, 'sqlite_errorname', '')
+    if name:
+        return name.startswith(('SQLITE_BUSY', 'SQLITE_LOCKED'))
+    msg = str(exc).lower()
+    return 'locked' in msg or 'busy' in msg
+
+
+@contextmanager
+def transaction(timeout: float = TX_TIMEOUT):
+    """
+    Open a write transaction with ``BEGIN IMMEDIATE``.
+
+    The RESERVED lock is taken up front, so a read-modify-write inside the block
+    cannot be interleaved with another process's write. On SQLITE_BUSY each
+    attempt has only waited BUSY_TIMEOUT_MS inside SQLite; the rest of the wait
+    is jittered ``time.sleep`` (cooperative under gevent) until ``timeout``
+    seconds have passed in total. Readers are never blocked (WAL).
+    """
+    deadline = time.monotonic() + timeout
+    delay = TX_RETRY_DELAY
+    with get_connection() as conn:
+        while True:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                break
+            except sqlite3.OperationalError as exc:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not _is_busy(exc):
+                    raise
+                time.sleep(min(delay * (0.5 + random.random()), remaining))
+                delay = min(delay * 2, TX_RETRY_MAX_DELAY)
+        yield conn
+
+
+def _upgrade_schema(conn) -> None:
+    """Bring the schema up to SCHEMA_VERSION. Each step is idempotent."""
+    old_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(users)')}
+    if 'data' in columns:
+        _migrate_legacy(conn)
+    else:
+        conn.execute(_USERS_DDL)
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(users)')}
+    if 'version' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'jobs'").fetchone() is not None:
+        if 'pid' not in {r[1] for r in conn.execute('PRAGMA table_info(jobs)')}:
+            conn.execute('ALTER TABLE jobs ADD COLUMN pid INTEGER')
+    # Superseded by idx_users_owner_created.
+    conn.execute('DROP INDEX IF EXISTS idx_users_owner')
+    for ddl in _USERS_INDEXES + _AUX_DDL:
+        conn.execute(ddl)
+    if old_version < 15:
+        # Older triggers counted short/empty times into several periods; rebuild.
+        conn.execute('DROP TRIGGER IF EXISTS ledger_rollup_ai')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ledger_rollup_ai'").fetchone() is None:
+        conn.execute(_LEDGER_ROLLUP_TRIGGER)
+        _rebuild_ledger_rollups(conn)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'applications_pending_ai'").fetchone() is None:
+        for ddl in _APPLICATIONS_TRIGGERS:
+            conn.execute(ddl)
+        _rebuild_pending_counts(conn)
+    try:
+        if old_version < 14:
+            # Recreated below with the users_fts_defer condition.
+            conn.execute('DROP TRIGGER IF EXISTS users_fts_ai')
+        for ddl in _USER_SEARCH_DDL:
+            conn.execute(ddl)
+        conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        pass
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def rebuild_user_search() -> None:
+    """Rebuild users_fts from the users table (e.g. after a VACUUM renumbered rowids)."""
+    _ensure_schema()
+    if _search_ready:
+        with transaction() as conn:
+            conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
 
 
 def init_db():
-    """Initialize the SQLite database and create table if not exists."""
-    with db_lock, sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            'CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, data TEXT)'
-        )
-        conn.commit()
+    """Initialize the SQLite database, creating or migrating the schema as needed."""
+    global _schema_ready, _search_ready
+    with get_connection() as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version < SCHEMA_VERSION:
+        with transaction() as conn:
+            # Re-check under the write lock so only one process migrates.
+            if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                _upgrade_schema(conn)
+    with get_connection() as conn:
+        # Refresh planner statistics so filtered list pages pick the right index.
+        conn.execute('PRAGMA optimize=0x10002')
+        _search_ready = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'users_fts'"
+        ).fetchone() is not None
+    _schema_ready = (os.getpid(), DB_PATH)
+
+
+class _UserCache:
+    """
+    Per-process read-through cache of decoded user rows.
+
+    Validity is tracked with the ``users_changes`` counter, which triggers bump on
+    every update or delete of a user row from any connection (server.py, main.py,
+    other gunicorn workers). Writes to other tables (ledger, rollups, jobs,
+    applications, bulk batches) leave the cache alone. A check is one primary-key read.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.key = None
+        self.conn = None
+        self.version = None
+        self.users = OrderedDict()
+
+    def current_version(self):
+        """Return the users change counter, clearing the cache if it moved."""
+        with self.lock:
+            key = (os.getpid(), DB_PATH)
+            if self.key != key:
+                self.conn = _open_connection()
+                self.key = key
+                self.version = None
+            version = self.conn.execute('SELECT n FROM users_changes WHERE id = 0').fetchone()[0]
+            if version != self.version:
+                self.users.clear()
+                self.version = version
+            return version
+
+    def get(self, username):
+        with self.lock:
+            info = self.users.get(username)
+            if info is not None:
+                self.users.move_to_end(username)
+            return info
+
+    def put(self, version, username, info) -> None:
+        with self.lock:
+            if version != self.version:
+                return
+            self.users[username] = info
+            self.users.move_to_end(username)
+            while len(self.users) > USER_CACHE_SIZE:
+                self.users.popitem(last=False)
+
+
+_user_cache = _UserCache()
 
 
 def load_users() -> dict:
-    """Load all users from the SQLite database as a dictionary."""
-    init_db()
-    with db_lock, sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.execute('SELECT username, data FROM users')
-        users = {}
-        for username, data in cursor.fetchall():
-            try:
-                users[username] = json.loads(data)
-            except Exception:
-                users[username] = {}
-        return users
+    """Load all users as a dictionary (whole table; prefer the row-level helpers)."""
+    _ensure_schema()
+    with get_connection() as conn:
+        return dict(_row_to_user(row) for row in conn.execute(_SELECT_USER))
 
 
 def save_users(users: dict) -> None:
     """Persist the provided users dictionary to the SQLite database."""
-    init_db()
-    with db_lock, sqlite3.connect(DB_PATH) as conn:
+    _ensure_schema()
+    with transaction() as conn:
         existing = {row[0] for row in conn.execute('SELECT username FROM users')}
-        for username, info in users.items():
+        conn.executemany(
+            _UPSERT_USER,
+            (_user_to_row(username, info) for username, info in users.items())
+        )
+        existing.difference_update(users)
+        conn.executemany(
+            'DELETE FROM users WHERE username = ?', ((u,) for u in existing)
+        )
+
+
+def get_user(username: str):
+    """Return a single user's data dict, or None if the user does not exist (cached)."""
+    _ensure_schema()
+    version = _user_cache.current_version()
+    info = _user_cache.get(username)
+    if info is None:
+        with get_connection() as conn:
+            row = conn.execute(
+                _SELECT_USER + ' WHERE username = ?', (username,)
+            ).fetchone()
+        if row is None:
+            return None
+        info = _row_to_user(row)[1]
+        _user_cache.put(version, username, info)
+    return dict(info)
+
+
+def get_user_versioned(username: str):
+    """Return ``(data, version)`` for one user, or None if the user does not exist."""
+    _ensure_schema()
+    with get_connection() as conn:
+        row = conn.execute(
+            _SELECT_USER.replace(', extra FROM', ', extra, version FROM', 1)
+            + ' WHERE username = ?', (username,)
+        ).fetchone()
+    if row is None:
+        return None
+    return _row_to_user(row[:-1])[1], row[-1]
+
+
+def iter_users(descending=None, admins_first: bool = False, **filters):
+    """
+    Yield (username, data) pairs one row at a time from a cursor, without loading
+    the table. ``filters`` are those of _user_filters; pass ``descending`` (and
+    ``admins_first``) to get the list-page ordering.
+    """
+    _ensure_schema()
+    where, params = _user_filters(**filters)
+    if descending is not None:
+        where += ' ORDER BY ' + _user_order(descending, admins_first)
+    with get_connection() as conn:
+        for row in conn.execute(_SELECT_USER + where, params):
+            yield _row_to_user(row)
+
+
+def _like_escape(text: str) -> str:
+    """Escape LIKE wildcards for use with ``ESCAPE '\\'``."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _user_filters(owner=None, source=None, enabled=None, forsale=None,
+                  start=None, end=None, q=None) -> tuple:
+    """
+    Build the WHERE clause and parameters shared by the user list queries.
+    ``None``/empty arguments are ignored; ``q`` is a case-insensitive substring of
+    the username or nickname.
+    """
+    clauses, params = [], []
+    if owner is not None:
+        clauses.append('owner = ?')
+        params.append(owner)
+    if source:
+        clauses.append('source = ?')
+        params.append(source)
+    if enabled is not None:
+        clauses.append('enabled = ?')
+        params.append(int(bool(enabled)))
+    if forsale is not None:
+        clauses.append('forsale = ?')
+        params.append(int(bool(forsale)))
+    if start:
+        clauses.append('created_at >= ?')
+        params.append(start)
+    if end:
+        clauses.append('created_at <= ?')
+        params.append(end)
+    if q:
+        if _search_ready and len(q) >= SEARCH_MIN_CHARS:
+            # Case-insensitive substring match on username or nickname via the trigram index.
+            clauses.append('rowid IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)')
+            params.append('"{}"'.format(q.replace('"', '""')))
+        else:
+            escaped = _like_escape(q)
+            clauses.append("(username LIKE ? ESCAPE '\\' OR nickname LIKE ? ESCAPE '\\')")
+            params.extend([f'%{escaped}%'] * 2)
+    where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    return where, params
+
+
+def _user_order(descending: bool, admins_first: bool) -> str:
+    """ORDER BY terms of the user list pages (served by the *_created indexes)."""
+    direction = 'DESC' if descending else 'ASC'
+    order = f'created_at {direction}, username {direction}'
+    if admins_first:
+        order = 'is_admin DESC, ' + order
+    return order
+
+
+def page_users(page: int = 1, per_page: int = 10, descending: bool = True,
+               admins_first: bool = False, **filters) -> tuple:
+    """
+    Return ``(items, total)`` for one page of users, filtered, ordered and counted
+    inside SQLite. ``items`` is a list of ``(username, data)``; ``filters`` are the
+    keyword arguments of _user_filters. Ordering is by created_at (admins first if
+    requested) with username as a stable tie-breaker.
+    """
+    _ensure_schema()
+    where, params = _user_filters(**filters)
+    order = _user_order(descending, admins_first)
+    page = max(int(page), 1)
+    per_page = max(int(per_page), 1)
+    with get_connection() as conn:
+        total = conn.execute('SELECT COUNT(*) FROM users' + where, params).fetchone()[0]
+        rows = conn.execute(
+            f'{_SELECT_USER}{where} ORDER BY {order} LIMIT ? OFFSET ?',
+            params + [per_page, (page - 1) * per_page]
+        ).fetchall()
+    return [_row_to_user(row) for row in rows], total
+
+
+def suggest_users(q: str, limit: int = 10, owner=None) -> list:
+    """
+    Typeahead helper: up to ``limit`` users whose username or nickname contains ``q``,
+    usernames starting with ``q`` first. Returns ``[{'username', 'nickname'}, ...]``.
+    """
+    if not q:
+        return []
+    _ensure_schema()
+    where, params = _user_filters(owner=owner, q=q)
+    escaped = _like_escape(q)
+    with get_connection() as conn:
+        rows = conn.execute(
+            f"SELECT username, nickname FROM users{where} "
+            f"ORDER BY username LIKE ? ESCAPE '\\' DESC, username LIMIT ?",
+            params + [f'{escaped}%', int(limit)]
+        ).fetchall()
+    return [{'username': u, 'nickname': n or ''} for u, n in rows]
+
+
+def insert_user(username: str, info: dict) -> bool:
+    """Insert a new user. Returns False if the username is already taken."""
+    _ensure_schema()
+    with transaction() as conn:
+        try:
+            conn.execute(_INSERT_USER, _user_to_row(username, info))
+        except sqlite3.IntegrityError:
+            return False
+    return True
+
+
+def patch_user(username: str, fields: dict, expected_version=None):
+    """
+    Merge ``fields`` into one user's data. Returns the updated dict, or None if missing.
+    If ``expected_version`` is given and the row has changed since, raise ConflictError.
+    """
+    _ensure_schema()
+    with transaction() as conn:
+        row = conn.execute(
+            _SELECT_USER.replace(', extra FROM', ', extra, version FROM', 1)
+            + ' WHERE username = ?', (username,)
+        ).fetchone()
+        if row is None:
+            return None
+        if expected_version is not None and row[-1] != expected_version:
+            raise ConflictError(username)
+        info = _row_to_user(row[:-1])[1]
+        info.update(fields)
+        conn.execute(_UPDATE_USER, _user_to_row(username, info)[1:] + (username,))
+    return info
+
+
+def modify_user(username: str, mutate, retries: int = CONFLICT_RETRIES):
+    """
+    Optimistic read-modify-write of one user.
+
+    ``mutate(info)`` receives a copy of the current data and returns the fields to
+    change (or None to change nothing). It runs without holding the write lock; if
+    the row's version moved in the meantime, the read and ``mutate`` are retried.
+    Returns the updated dict, or None if the user does not exist.
+    """
+    for attempt in range(retries + 1):
+        current = get_user_versioned(username)
+        if current is None:
+            return None
+        info, version = current
+        fields = mutate(dict(info))
+        if not fields:
+            return info
+        try:
+            return patch_user(username, fields, expected_version=version)
+        except ConflictError:
+            if attempt == retries:
+                raise
+
+
+def rename_user(old: str, new: str) -> bool:
+    """Rename a user. Returns False if ``old`` is missing or ``new`` is taken."""
+    _ensure_schema()
+    with transaction() as conn:
+        try:
+            cur = conn.execute(
+                'UPDATE users SET username = ?, version = version + 1 WHERE username = ?',
+                (new, old)
+            )
+        except sqlite3.IntegrityError:
+            return False
+    return cur.rowcount > 0
+
+
+def remove_user(username: str) -> bool:
+    """Delete one user. Returns False if the user did not exist."""
+    _ensure_schema()
+    with transaction() as conn:
+        cur = conn.execute('DELETE FROM users WHERE username = ?', (username,))
+    return cur.rowcount > 0
+
+
+# Batch actions: SET clause plus the condition for rows it would actually change.
+_USER_BATCH_SET = {
+    'enable': ('enabled = 1', 'enabled = 0'),
+    'disable': ('enabled = 0', 'enabled = 1'),
+    'sold': ('forsale = 0', 'forsale = 1'),
+}
+USER_BATCH_ACTIONS = tuple(_USER_BATCH_SET) + ('delete',)
+
+
+def batch_update_users(action: str, names, owner=None, sale=None) -> int:
+    """
+    Apply ``action`` (see USER_BATCH_ACTIONS) to ``names`` with one UPDATE/DELETE.
+
+    The names go into a per-connection temp table, so the statement does not
+    depend on the number of names. ``owner`` restricts the batch to that owner's
+    users. For 'sold' with ``sale`` (ledger fields such as time/admin/role), one
+    ledger row per sold user is appended in the same transaction, priced from
+    the user row. Unknown names and rows already in the target state are skipped.
+    Returns the number of users changed.
+    """
+    if action not in USER_BATCH_ACTIONS:
+        raise ValueError(f'unknown batch action: {action}')
+    names = list(names)
+    if not names:
+        return 0
+    _ensure_schema()
+    where = 'username IN (SELECT username FROM temp.batch_names)'
+    params = ()
+    if owner is not None:
+        where += ' AND owner = ?'
+        params = (owner,)
+    with transaction() as conn:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS batch_names (username TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM temp.batch_names')
+        conn.executemany(
+            'INSERT OR IGNORE INTO temp.batch_names (username) VALUES (?)', ((n,) for n in names)
+        )
+        if action == 'delete':
+            cur = conn.execute(f'DELETE FROM users WHERE {where}', params)
+            return cur.rowcount
+        assign, pending = _USER_BATCH_SET[action]
+        where += f' AND {pending}'
+        if action == 'sold' and sale is not None:
+            time_, role, admin, agent, _, _, _, _, extra = _ledger_to_row(sale)
             conn.execute(
-                'REPLACE INTO users (username, data) VALUES (?, ?)',
-                (username, json.dumps(info, ensure_ascii=False))
+                'INSERT INTO ledger ({}, extra) '
+                "SELECT ?, ?, ?, ?, COALESCE(product, ''), COALESCE(price, 0), 1, "
+                'COALESCE(price, 0), ? FROM users WHERE {}'.format(', '.join(LEDGER_COLUMNS), where),
+                (time_, role, admin, agent, extra) + params
+            )
+        cur = conn.execute(
+            f'UPDATE users SET {assign}, version = version + 1 WHERE {where}', params
+        )
+        return cur.rowcount
+
+
+def _reserve_id_range(conn, count: int) -> tuple:
+    """
+    Reserve ``count`` consecutive sequence numbers for the current second inside
+    ``conn``'s write transaction. Returns ``(stamp, first, last)``.
+    """
+    ts = datetime.now().strftime('%Y%m%d%H%M%S')
+    row = conn.execute('SELECT last FROM user_id_seq WHERE stamp = ?', (ts,)).fetchone()
+    if row is not None:
+        last = row[0]
+    else:
+        # First allocation this second: honour IDs written by older code paths.
+        last = 0
+        for (uid,) in conn.execute(
+            'SELECT user_id FROM users WHERE user_id >= ? AND user_id < ?',
+            (ts, ts + ':')
+        ):
+            suffix = uid[len(ts):]
+            if suffix.isdigit():
+                last = max(last, int(suffix))
+        conn.execute('DELETE FROM user_id_seq WHERE stamp < ?', (ts,))
+    conn.execute(
+        'INSERT INTO user_id_seq (stamp, last) VALUES (?, ?) '
+        'ON CONFLICT(stamp) DO UPDATE SET last = excluded.last',
+        (ts, last + count)
+    )
+    return ts, last + 1, last + count
+
+
+def _reserve_user_ids(conn, count: int) -> list:
+    """Reserve ``count`` user IDs (timestamp + sequence) inside ``conn``'s transaction."""
+    if count <= 0:
+        return []
+    ts, first, last = _reserve_id_range(conn, count)
+    return [f"{ts}{seq:03d}" for seq in range(first, last + 1)]
+
+
+class _IdBlock:
+    """Sequence numbers this process reserved for one second but has not handed out."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.key = None
+        self.stamp = None
+        self.next = 0
+        self.last = -1
+
+
+_id_block = _IdBlock()
+
+
+def allocate_user_ids(count: int = 1) -> list:
+    """
+    Hand out ``count`` unique user IDs in the ``YYYYmmddHHMMSS`` + ``%03d`` format.
+
+    IDs come from the shared ``user_id_seq`` table, so they are unique across
+    gunicorn workers and processes. Each process reserves a block of
+    ID_BLOCK_SIZE numbers at a time and serves later calls in the same second
+    from memory; unused numbers are simply skipped. Never scans the users table.
+    """
+    if count <= 0:
+        return []
+    _ensure_schema()
+    ids = []
+    block = _id_block
+    with block.lock:
+        ts = datetime.now().strftime('%Y%m%d%H%M%S')
+        if block.key != (os.getpid(), DB_PATH) or block.stamp != ts:
+            block.key = (os.getpid(), DB_PATH)
+            block.stamp, block.next, block.last = ts, 0, -1
+        while block.next <= block.last and len(ids) < count:
+            ids.append(f"{block.stamp}{block.next:03d}")
+            block.next += 1
+        if len(ids) < count:
+            with transaction() as conn:
+                stamp, first, last = _reserve_id_range(conn, count - len(ids) + ID_BLOCK_SIZE)
+            block.stamp, block.next, block.last = stamp, first, last
+            while len(ids) < count:
+                ids.append(f"{block.stamp}{block.next:03d}")
+                block.next += 1
+    return ids
+
+
+@contextmanager
+def _bulk_search_index(conn):
+    """
+    Wrap a bulk insert into users inside ``conn``'s write transaction: the per-row
+    users_fts trigger is suspended and the new rows are indexed with a single
+    INSERT ... SELECT afterwards. Updated rows still go through the update trigger.
+    """
+    if not _search_ready:
+        yield
+        return
+    # New rowids are above the current maximum while we hold the write lock.
+    last = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM users').fetchone()[0]
+    conn.execute('INSERT OR IGNORE INTO users_fts_defer (id) VALUES (0)')
+    yield
+    conn.execute('DELETE FROM users_fts_defer')
+    conn.execute(
+        'INSERT INTO users_fts (rowid, username, nickname) '
+        'SELECT rowid, username, nickname FROM users WHERE rowid > ?', (last,)
+    )
+
+
+def _existing_usernames(conn, names) -> set:
+    """Return which of ``names`` already exist, probing the primary key in chunks."""
+    names = list(names)
+    found = set()
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        found.update(r[0] for r in conn.execute(
+            'SELECT username FROM users WHERE username IN ({})'.format(','.join('?' * len(chunk))),
+            chunk
+        ))
+    return found
+
+
+def create_users(new_users: dict, overwrite: bool = False) -> list:
+    """
+    Insert many users in one transaction with a single executemany.
+
+    Users without a ``user_id`` get one reserved from the ID sequence. Existing
+    usernames are skipped, or replaced when ``overwrite`` is true. Returns the
+    usernames that were written.
+    """
+    _ensure_schema()
+    with transaction() as conn:
+        names = list(new_users)
+        if not overwrite:
+            taken = _existing_usernames(conn, names)
+            names = [n for n in names if n not in taken]
+        missing = [n for n in names if not new_users[n].get('user_id')]
+        for name, uid in zip(missing, _reserve_user_ids(conn, len(missing))):
+            new_users[name] = dict(new_users[name], user_id=uid)
+        with _bulk_search_index(conn):
+            conn.executemany(
+                _UPSERT_USER if overwrite else _INSERT_USER,
+                (_user_to_row(n, new_users[n]) for n in names)
+            )
+    return names
+
+
+def existing_usernames(names) -> set:
+    """Return the subset of ``names`` that already exist (primary-key probes)."""
+    _ensure_schema()
+    with get_connection() as conn:
+        return _existing_usernames(conn, names)
+
+
+def _generate_accounts(conn, count: int, generate) -> dict:
+    """Draw ``count`` unused ``{username: password}`` pairs from ``generate()``."""
+    accounts = {}
+    while len(accounts) < count:
+        batch = {}
+        while len(accounts) + len(batch) < count:
+            name, pwd = generate()
+            if name not in accounts:
+                batch[name] = pwd
+        for name in _existing_usernames(conn, batch):
+            batch.pop(name)
+        accounts.update(batch)
+    return accounts
+
+
+def create_generated_users(count: int, template: dict, generate, batch_id=None,
+                           first_seq: int = 0, ledger=None) -> list:
+    """
+    Create ``count`` users with generated credentials in one transaction.
+
+    ``generate()`` returns a ``(username, password)`` pair; names that collide with
+    existing users (checked against the primary key) or with each other are
+    regenerated. Every user gets ``template`` plus a sequence-reserved ``user_id``.
+    With ``batch_id`` the credentials are also saved to ``bulk_accounts`` in the
+    same transaction, numbered from ``first_seq`` (see page_bulk_accounts /
+    iter_bulk_accounts). A ``ledger`` record is appended in that transaction too.
+    Returns ``[{'username': ..., 'password': ...}, ...]``.
+    """
+    if count <= 0:
+        return []
+    _ensure_schema()
+    with transaction() as conn:
+        accounts = _generate_accounts(conn, count, generate)
+        ids = _reserve_user_ids(conn, count)
+        with _bulk_search_index(conn):
+            conn.executemany(
+                _INSERT_USER,
+                (_user_to_row(name, dict(template, user_id=uid, password=pwd))
+                 for (name, pwd), uid in zip(accounts.items(), ids))
             )
-            existing.discard(username)
-        for username in existing:
-            conn.execute('DELETE FROM users WHERE username = ?', (username,))
-        conn.commit()
+        if batch_id is not None:
+            conn.executemany(
+                'INSERT OR REPLACE INTO bulk_accounts (batch_id, seq, username, password) '
+                'VALUES (?, ?, ?, ?)',
+                ((batch_id, seq, name, pwd)
+                 for seq, (name, pwd) in enumerate(accounts.items(), first_seq))
+            )
+        if ledger:
+            conn.execute(_INSERT_LEDGER, _ledger_to_row(ledger))
+    return [{'username': name, 'password': pwd} for name, pwd in accounts.items()]
+
+
+def page_bulk_accounts(batch_id: str, page: int = 1, per_page: int = 20) -> tuple:
+    """Return ``([{'username', 'password'}, ...], total)`` for one page of a bulk batch."""
+    _ensure_schema()
+    offset = (max(page, 1) - 1) * per_page
+    with get_connection() as conn:
+        total = conn.execute(
+            'SELECT COUNT(*) FROM bulk_accounts WHERE batch_id = ?', (batch_id,)
+        ).fetchone()[0]
+        rows = conn.execute(
+            'SELECT username, password FROM bulk_accounts WHERE batch_id = ? AND seq >= ? '
+            'ORDER BY seq LIMIT ?', (batch_id, offset, per_page)
+        ).fetchall()
+    return [{'username': name, 'password': pwd} for name, pwd in rows], total
+
+
+def iter_bulk_accounts(batch_id: str):
+    """Yield ``(username, password)`` for a bulk batch in generation order."""
+    _ensure_schema()
+    with get_connection() as conn:
+        yield from conn.execute(
+            'SELECT username, password FROM bulk_accounts WHERE batch_id = ? ORDER BY seq',
+            (batch_id,)
+        )
+
+
+_INSERT_LEDGER = 'INSERT INTO ledger ({}, extra) VALUES ({})'.format(
+    ', '.join(LEDGER_COLUMNS), ', '.join('?' * (len(LEDGER_COLUMNS) + 1))
+)
+_SELECT_LEDGER = 'SELECT {}, extra FROM ledger'.format(', '.join(LEDGER_COLUMNS))
+
+
+def _ledger_to_row(record: dict) -> tuple:
+    """Split a ledger record into column values plus the JSON overflow."""
+    values = [record.get(col) for col in LEDGER_COLUMNS]
+    values[0] = values[0] or ''
+    values[1] = values[1] or 'admin'
+    extra = {k: v for k, v in record.items() if k not in LEDGER_COLUMNS}
+    return (*values, json.dumps(extra, ensure_ascii=False) if extra else None)
+
+
+def _row_to_ledger(row) -> dict:
+    """Rebuild a ledger record dict from a row selected with ``_SELECT_LEDGER``."""
+    *values, extra = row
+    record = {}
+    if extra:
+        try:
+            record.update(json.loads(extra))
+        except Exception:
+            pass
+    record.update((col, value) for col, value in zip(LEDGER_COLUMNS, values) if value is not None)
+    return record
+
+
+def add_ledger_records(records: list) -> None:
+    """Append ledger records (one INSERT each, no reads). ``role`` defaults to 'admin'."""
+    if not records:
+        return
+    _ensure_schema()
+    with transaction() as conn:
+        conn.executemany(_INSERT_LEDGER, (_ledger_to_row(r) for r in records))
+
+
+def add_ledger_record(record: dict) -> None:
+    """Append a single ledger record."""
+    add_ledger_records([record])
+
+
+def _ledger_filters(role=None, admin=None, agent=None, product=None,
+                    start=None, end=None) -> tuple:
+    """Build the WHERE clause and parameters for ledger queries."""
+    clauses, params = [], []
+    for col, value in (('role', role), ('admin', admin), ('agent', agent), ('product', product)):
+        if value:
+            clauses.append(f'{col} = ?')
+            params.append(value)
+    if start:
+        clauses.append('time >= ?')
+        params.append(start)
+    if end:
+        clauses.append('time <= ?')
+        params.append(end)
+    where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    return where, params
+
+
+def query_ledger(role=None, admin=None, agent=None, product=None,
+                 start=None, end=None) -> list:
+    """
+    Return ledger records matching the filters in insertion order.
+    ``start``/``end`` compare against the ``time`` string; empty arguments are ignored.
+    """
+    _ensure_schema()
+    where, params = _ledger_filters(role, admin, agent, product, start, end)
+    with get_connection() as conn:
+        return [_row_to_ledger(row) for row in
+                conn.execute(f'{_SELECT_LEDGER}{where} ORDER BY id', params)]
+
+
+def ledger_revenue(prefix: str = '', **filters) -> float:
+    """
+    Sum ``revenue`` over records whose time starts with ``prefix`` (e.g. '2024-05'),
+    as an index range scan. ``filters`` are the keyword arguments of query_ledger.
+    """
+    _ensure_schema()
+    where, params = _ledger_filters(**filters)
+    if prefix:
+        where += (' AND ' if where else ' WHERE ') + 'time >= ? AND time < ?'
+        params += [prefix, prefix + '\uffff']
+    with get_connection() as conn:
+        return conn.execute(f'SELECT COALESCE(SUM(revenue), 0) FROM ledger{where}', params).fetchone()[0]
+
+
+def _rebuild_ledger_rollups(conn) -> None:
+    """Recompute every rollup row from the ledger inside the caller's transaction."""
+    conn.execute('DELETE FROM ledger_rollup')
+    conn.execute(
+        'INSERT INTO ledger_rollup (period, role, admin, agent, product, revenue, records) '
+        'SELECT period, role, admin, agent, product, SUM(revenue), COUNT(*) FROM ('
+        + _ROLLUP_CUBE.format(r='l', src='ledger AS l,') +
+        ') GROUP BY period, role, admin, agent, product'
+    )
+
+
+def rebuild_ledger_rollups() -> None:
+    """Recompute ledger_rollup from the ledger table (backfill / repair)."""
+    _ensure_schema()
+    with transaction() as conn:
+        _rebuild_ledger_rollups(conn)
+
+
+def ledger_rollup(periods, role: str, admin=None, agent=None, product=None) -> dict:
+    """
+    Return ``{period: revenue}`` for the given periods ('YYYY-MM-DD', 'YYYY-MM',
+    'YYYY' or '' for all time) from the pre-aggregated rollups. Empty dimension
+    arguments mean "any"; periods without sales map to 0.
+    """
+    periods = list(periods)
+    _ensure_schema()
+    with get_connection() as conn:
+        rows = conn.execute(
+            'SELECT period, revenue FROM ledger_rollup WHERE period IN ({}) '
+            'AND role = ? AND admin = ? AND agent = ? AND product = ?'.format(','.join('?' * len(periods))),
+            periods + [role, admin or '*', agent or '*', product or '*']
+        ).fetchall()
+    found = dict(rows)
+    return {p: found.get(p, 0) for p in periods}
+
+
+def import_ledger_json(path: str) -> int:
+    """
+    One-time import of a legacy ``{"records": [...]}`` ledger file.
+
+    Runs only while the ledger table is still empty, so it is safe to call on
+    every startup from every worker. Returns the number of imported records.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return 0
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            records = json.load(f).get('records', [])
+    except Exception:
+        return 0
+    records = [r for r in records if isinstance(r, dict)]
+    if not records:
+        return 0
+    _ensure_schema()
+    with transaction() as conn:
+        if conn.execute('SELECT 1 FROM ledger LIMIT 1').fetchone():
+            return 0
+        conn.executemany(_INSERT_LEDGER, (_ledger_to_row(r) for r in records))
+    return len(records)
+
+
+def pending_counts(agent=None) -> tuple:
+    """Return ``(total_pending, pending_for_agent)`` from the maintained counters."""
+    _ensure_schema()
+    with get_connection() as conn:
+        found = dict(conn.execute(
+            "SELECT agent, pending FROM pending_apps WHERE agent IN ('*', ?)", (agent or '*',)
+        ).fetchall())
+    return found.get('*', 0), (found.get(agent, 0) if agent else 0)
+
+
+_SELECT_APPLICATION = 'SELECT id, {}, extra FROM applications'.format(', '.join(APPLICATION_COLUMNS))
+_INSERT_APPLICATION = 'INSERT OR IGNORE INTO applications (id, {}, extra) VALUES ({})'.format(
+    ', '.join(APPLICATION_COLUMNS), ', '.join('?' * (len(APPLICATION_COLUMNS) + 2))
+)
+
+
+def _application_to_row(record: dict) -> tuple:
+    """Split an application dict into column values plus the JSON overflow."""
+    values = [record.get(col) for col in APPLICATION_COLUMNS]
+    values[4] = values[4] or 'pending'
+    values[5] = values[5] or ''
+    extra = {k: v for k, v in record.items() if k != 'id' and k not in APPLICATION_COLUMNS}
+    return (record['id'], *values, json.dumps(extra, ensure_ascii=False) if extra else None)
+
+
+def _row_to_application(row) -> dict:
+    """Rebuild an application dict from a row selected with ``_SELECT_APPLICATION``."""
+    app_id, *values, extra = row
+    record = {}
+    if extra:
+        try:
+            record.update(json.loads(extra))
+        except Exception:
+            pass
+    record['id'] = app_id
+    record.update((col, value) for col, value in zip(APPLICATION_COLUMNS, values) if value is not None)
+    return record
+
+
+def _rebuild_pending_counts(conn) -> None:
+    """Recount pending_apps from the applications table inside the caller's transaction."""
+    conn.execute('DELETE FROM pending_apps')
+    conn.execute(
+        "INSERT INTO pending_apps (agent, pending) SELECT COALESCE(agent, ''), COUNT(*) "
+        "FROM applications WHERE status = 'pending' GROUP BY COALESCE(agent, '')"
+    )
+    conn.execute(
+        "INSERT INTO pending_apps (agent, pending) "
+        "SELECT '*', COUNT(*) FROM applications WHERE status = 'pending'"
+    )
+
+
+def _applications_by_id(conn, ids) -> dict:
+    """Fetch ``{id: application}`` for the given IDs, querying in chunks."""
+    ids = list(ids)
+    found = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        for row in conn.execute(
+            _SELECT_APPLICATION + ' WHERE id IN ({})'.format(','.join('?' * len(chunk))), chunk
+        ):
+            record = _row_to_application(row)
+            found[record['id']] = record
+    return found
+
+
+def create_application(record: dict) -> str:
+    """Insert a new application (``status`` defaults to 'pending'); returns its id."""
+    record = dict(record)
+    record.setdefault('id', os.urandom(6).hex())
+    _ensure_schema()
+    with transaction() as conn:
+        conn.execute(_INSERT_APPLICATION, _application_to_row(record))
+    return record['id']
+
+
+def list_applications(agent=None, status=None) -> list:
+    """Return applications in submission order, optionally filtered by agent/status."""
+    clauses, params = [], []
+    if agent:
+        clauses.append('agent = ?')
+        params.append(agent)
+    if status:
+        clauses.append('status = ?')
+        params.append(status)
+    where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    _ensure_schema()
+    with get_connection() as conn:
+        return [_row_to_application(row) for row in
+                conn.execute(f'{_SELECT_APPLICATION}{where} ORDER BY rowid', params)]
+
+
+def patch_application(app_id: str, fields: dict) -> bool:
+    """Update columns of a still-pending application. Returns False if none matched."""
+    fields = {k: v for k, v in fields.items() if k in APPLICATION_COLUMNS}
+    if not fields:
+        return False
+    _ensure_schema()
+    with transaction() as conn:
+        cur = conn.execute(
+            'UPDATE applications SET {} WHERE id = ? AND status = ?'.format(
+                ', '.join(f'{k} = ?' for k in fields)),
+            [*fields.values(), app_id, 'pending']
+        )
+    return cur.rowcount > 0
+
+
+def _decide_skipped(ids, found) -> dict:
+    """Results for IDs that cannot be decided: unknown or no longer pending."""
+    results = {}
+    for app_id in ids:
+        record = found.get(app_id)
+        if record is None:
+            results[app_id] = {'result': 'not_found'}
+        elif record.get('status') != 'pending':
+            results[app_id] = {'result': 'not_pending', 'status': record.get('status')}
+    return results
+
+
+def reject_applications(ids) -> dict:
+    """
+    Reject the pending applications among ``ids`` in one transaction.
+    Returns ``{id: {'result': 'rejected' | 'not_found' | 'not_pending', ...}}``.
+    """
+    ids = list(dict.fromkeys(ids))
+    _ensure_schema()
+    with transaction() as conn:
+        found = _applications_by_id(conn, ids)
+        results = _decide_skipped(ids, found)
+        pending = [app_id for app_id in ids if app_id not in results]
+        conn.executemany(
+            "UPDATE applications SET status = 'rejected' WHERE id = ?", ((i,) for i in pending)
+        )
+    results.update((app_id, {'result': 'rejected'}) for app_id in pending)
+    return {app_id: results[app_id] for app_id in ids}
+
+
+def approve_applications(ids, generate, build) -> dict:
+    """
+    Approve the pending applications among ``ids`` in one transaction.
+
+    ``build(app)`` returns ``(user_template, ledger_record)`` for an application;
+    ``generate()`` returns ``(username, password)`` pairs as in create_generated_users.
+    Credentials, user IDs, users and ledger rows for all selected applications are
+    created set-wise (one ID reservation, one executemany per table), so either every
+    selected application is approved or none is.
+
+    Returns ``{id: result}`` in the order of ``ids``; ``result['result']`` is
+    'approved' (with the number of created ``accounts``), 'not_found' or
+    'not_pending' (with the current ``status``).
+    """
+    ids = list(dict.fromkeys(ids))
+    _ensure_schema()
+    with transaction() as conn:
+        found = _applications_by_id(conn, ids)
+        results = _decide_skipped(ids, found)
+        pending = [found[app_id] for app_id in ids if app_id not in results]
+        counts = [max(int(a.get('count') or 0), 0) for a in pending]
+        total = sum(counts)
+        credentials = iter(zip(_generate_accounts(conn, total, generate).items(),
+                               _reserve_user_ids(conn, total)))
+        user_rows, ledger_rows = [], []
+        for record, count in zip(pending, counts):
+            template, ledger = build(record)
+            for _ in range(count):
+                (name, pwd), uid = next(credentials)
+                user_rows.append(_user_to_row(name, dict(template, user_id=uid, password=pwd)))
+            if ledger:
+                ledger_rows.append(_ledger_to_row(ledger))
+            results[record['id']] = {'result': 'approved', 'accounts': count}
+        with _bulk_search_index(conn):
+            conn.executemany(_INSERT_USER, user_rows)
+        conn.executemany(_INSERT_LEDGER, ledger_rows)
+        conn.executemany(
+            "UPDATE applications SET status = 'approved' WHERE id = ?",
+            ((record['id'],) for record in pending)
+        )
+    return {app_id: results[app_id] for app_id in ids}
+
+
+def import_applications_json(path: str) -> int:
+    """
+    One-time import of a legacy ``{"apps": [...]}`` applications file, run only
+    while the applications table is empty. Returns the number of imported rows.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return 0
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            apps = json.load(f).get('apps', [])
+    except Exception:
+        return 0
+    apps = [a for a in apps if isinstance(a, dict) and a.get('id')]
+    if not apps:
+        return 0
+    _ensure_schema()
+    with transaction() as conn:
+        if conn.execute('SELECT 1 FROM applications LIMIT 1').fetchone():
+            return 0
+        conn.executemany(_INSERT_APPLICATION, (_application_to_row(a) for a in apps))
+    return len(apps)
+
+
+def _now() -> str:
+    """Current local time in the ``YYYY-MM-DD HH:MM:SS`` format used across tables."""
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def create_job(kind: str, owner=None, params=None, total: int = 0) -> str:
+    """Record a new queued job owned by the current process and return its id."""
+    job_id = os.urandom(8).hex()
+    now = _now()
+    _ensure_schema()
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO jobs (id, kind, owner, total, params, created_at, updated_at, pid) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, owner, int(total),
+             json.dumps(params, ensure_ascii=False) if params is not None else None,
+             now, now, os.getpid())
+        )
+    return job_id
+
+
+def touch_jobs(job_ids) -> None:
+    """Heartbeat: bump updated_at of the given jobs that are still queued or running."""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return
+    _ensure_schema()
+    with transaction() as conn:
+        conn.execute(
+            'UPDATE jobs SET updated_at = ? WHERE status IN (?, ?) AND id IN ({})'.format(
+                ','.join('?' * len(job_ids))),
+            [_now(), *_ACTIVE_JOB_STATUSES, *job_ids]
+        )
+
+
+def _pid_alive(pid) -> bool:
+    """Return False only if ``pid`` is known not to exist on this host."""
+    if not pid or os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _job_is_stale(status, pid, updated_at, cutoff: str) -> bool:
+    return status in _ACTIVE_JOB_STATUSES and (updated_at < cutoff or not _pid_alive(pid))
+
+
+def fail_stale_jobs() -> int:
+    """
+    Mark queued/running jobs as failed when their process has exited or their
+    heartbeat is older than JOB_STALE_SECONDS (worker restarted, recycled or
+    crashed). Returns the number of jobs failed.
+    """
+    cutoff = _stale_cutoff()
+    _ensure_schema()
+    with get_connection() as conn:
+        rows = conn.execute(
+            'SELECT id, status, pid, updated_at FROM jobs WHERE status IN (?, ?)',
+            _ACTIVE_JOB_STATUSES
+        ).fetchall()
+    stale = [job_id for job_id, *rest in rows if _job_is_stale(*rest, cutoff)]
+    return _fail_jobs(stale, cutoff)
+
+
+def _stale_cutoff() -> str:
+    return (datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _fail_jobs(job_ids, cutoff: str) -> int:
+    """Fail ``job_ids`` unless they are finished or have sent a heartbeat meanwhile."""
+    if not job_ids:
+        return 0
+    with transaction() as conn:
+        rows = conn.execute(
+            'SELECT id, status, pid, updated_at FROM jobs WHERE id IN ({})'.format(
+                ','.join('?' * len(job_ids))), job_ids
+        ).fetchall()
+        stale = [job_id for job_id, *rest in rows if _job_is_stale(*rest, cutoff)]
+        conn.executemany(
+            "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+            (('worker process exited before the job finished', _now(), job_id) for job_id in stale)
+        )
+    return len(stale)
+
+
+def update_job(job_id: str, **fields) -> None:
+    """Set job columns (``params``/``result`` are stored as JSON); bumps updated_at."""
+    fields = {k: v for k, v in fields.items() if k in JOB_COLUMNS}
+    for col in _JSON_JOB_COLUMNS:
+        if fields.get(col) is not None:
+            fields[col] = json.dumps(fields[col], ensure_ascii=False)
+    fields['updated_at'] = _now()
+    _ensure_schema()
+    with transaction() as conn:
+        conn.execute(
+            'UPDATE jobs SET {} WHERE id = ?'.format(', '.join(f'{k} = ?' for k in fields)),
+            [*fields.values(), job_id]
+        )
+
+
+def get_job(job_id: str):
+    """Return the job as a dict (JSON columns decoded), or None. Fails it first if stale."""
+    _ensure_schema()
+    select = 'SELECT id, {} FROM jobs WHERE id = ?'.format(', '.join(JOB_COLUMNS))
+    with get_connection() as conn:
+        row = conn.execute(select, (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(('id',) + JOB_COLUMNS, row))
+    cutoff = _stale_cutoff()
+    if _job_is_stale(job['status'], job['pid'], job['updated_at'], cutoff):
+        _fail_jobs([job_id], cutoff)
+        with get_connection() as conn:
+            job = dict(zip(('id',) + JOB_COLUMNS, conn.execute(select, (job_id,)).fetchone()))
+    for col in _JSON_JOB_COLUMNS:
+        if job[col]:
+            try:
+                job[col] = json.loads(job[col])
+            except Exception:
+                job[col] = None
+    return job
+
+
+def list_jobs(limit: int = 50, kind=None) -> list:
+    """Return the most recent jobs (newest first) without their params/result payloads."""
+    where, params = ('', []) if not kind else (' WHERE kind = ?', [kind])
+    _ensure_schema()
+    fail_stale_jobs()
+    with get_connection() as conn:
+        rows = conn.execute(
+            'SELECT id, kind, owner, status, total, done, error, created_at, updated_at '
+            f'FROM jobs{where} ORDER BY created_at DESC, rowid DESC LIMIT ?', params + [int(limit)]
+        ).fetchall()
+    keys = ('id', 'kind', 'owner', 'status', 'total', 'done', 'error', 'created_at', 'updated_at')
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def add_job_rejects(job_id: str, rejects) -> None:
+    """Store ``(row, username, reason)`` tuples for rows a job could not process."""
+    rejects = list(rejects)
+    if not rejects:
+        return
+    _ensure_schema()
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO job_rejects (job_id, row, username, reason) VALUES (?, ?, ?, ?)',
+            ((job_id, *r) for r in rejects)
+        )
+
+
+def iter_job_rejects(job_id: str):
+    """Yield ``(row, username, reason)`` for a job in row order."""
+    _ensure_schema()
+    with get_connection() as conn:
+        yield from conn.execute(
+            'SELECT row, username, reason FROM job_rejects WHERE job_id = ? ORDER BY row', (job_id,)
+        )
@@ -0,0 +1,369 @@
+import os
+import csv
+import mmap
+import time
+import socket
+import struct
+import bisect
+import ipaddress
+from array import array
+from collections import OrderedDict
+from queue import Queue, Full
+from threading import Lock, Thread
+
+import requests
+
+from db_utils import get_user, modify_user
+
+# IP -> location entries kept per process, shared by every user.
+LOCATION_CACHE_SIZE = 50000
+# Seconds a resolved location stays valid; failed lookups are retried sooner.
+LOCATION_TTL = 7 * 24 * 3600
+LOCATION_FAIL_TTL = 300
+
+# Pending lookups; when full, new requests are dropped (the next login retries).
+LOCATION_QUEUE_SIZE = 1000
+
+IP_API_URL = 'http://ip-api.com/json/{}?lang=zh-CN'
+IP_API_TIMEOUT = 3
+# ip-api.com is only consulted for addresses missing from the local range file.
+IP_API_FALLBACK = os.environ.get('IP_API_FALLBACK', '1') != '0'
+
+# Local IPv4 range database (see build_ip_database), memory-mapped and re-checked
+# for replacement at most every IP_DB_CHECK_INTERVAL seconds.
+IP_DB_PATH = os.environ.get(
+    'IP_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ip_ranges.dat')
+)
+IP_DB_CHECK_INTERVAL = 5
+
+# File layout (native byte order, every section 4-byte aligned):
+#   header   magic, byte-order mark, range count n, location count m
+#   starts   n x u32, sorted ascending (bisected in place through the mmap)
+#   ends     n x u32, inclusive
+#   names    n x u32 index into the location table
+#   offsets  (m + 1) x u32 byte offsets into the UTF-8 blob
+#   blob     concatenated UTF-8 location strings
+_IPDB_HEADER = struct.Struct('=4sIII')
+_IPDB_MAGIC = b'IPDB'
+_IPDB_BOM = 0x01020304
+
+
+def _ipv4_to_int(ip: str):
+    """Return an IPv4 address as an int, or None for IPv6/invalid input."""
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, ValueError):
+        return None
+
+
+def _parse_ipv4(value: str):
+    value = value.strip()
+    return int(value) if value.isdigit() else _ipv4_to_int(value)
+
+
+def build_ip_database(csv_path: str, out_path: str = IP_DB_PATH) -> int:
+    """
+    Build the binary range file from a CSV of ``start,end,location...`` rows.
+
+    ``start``/``end`` are dotted IPv4 addresses or integers (inclusive); any further
+    non-empty columns (e.g. country, region, city) are joined with '-'. Header,
+    IPv6 and malformed rows are skipped. The file is written next to ``out_path``
+    and moved into place atomically, so running servers pick it up on their next
+    reload check. Returns the number of ranges written.
+    """
+    ranges = []
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.reader(f):
+            if len(row) < 3:
+                continue
+            start, end = _parse_ipv4(row[0]), _parse_ipv4(row[1])
+            location = '-'.join(p.strip() for p in row[2:] if p.strip())
+            if start is None or end is None or end < start or not location:
+                continue
+            ranges.append((start, end, location))
+    ranges.sort()
+    names = {}
+    starts, ends, name_idx = array('I'), array('I'), array('I')
+    for start, end, location in ranges:
+        starts.append(start)
+        ends.append(end)
+        name_idx.append(names.setdefault(location, len(names)))
+    offsets, blob = array('I', [0]), bytearray()
+    for location in names:
+        blob += location.encode('utf-8')
+        offsets.append(len(blob))
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_IPDB_HEADER.pack(_IPDB_MAGIC, _IPDB_BOM, len(starts), len(names)))
+        for part in (starts, ends, name_idx, offsets):
+            f.write(part.tobytes())
+        f.write(blob)
+    os.replace(tmp_path, out_path)
+    return len(starts)
+
+
+class _IPRangeFile:
+    """One opened, memory-mapped range file."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bom, n, m = _IPDB_HEADER.unpack_from(self.mm)
+        if magic != _IPDB_MAGIC or bom != _IPDB_BOM:
+            raise ValueError(f'{path}: not an IP range file for this platform, rebuild it')
+        view = memoryview(self.mm)
+        pos = _IPDB_HEADER.size
+        self.starts = view[pos:pos + 4 * n].cast('I')
+        self.ends = view[pos + 4 * n:pos + 8 * n].cast('I')
+        self.names = view[pos + 8 * n:pos + 12 * n].cast('I')
+        self.offsets = view[pos + 12 * n:pos + 12 * n + 4 * (m + 1)].cast('I')
+        self.blob = pos + 12 * n + 4 * (m + 1)
+
+    def lookup(self, value: int):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i < 0 or value > self.ends[i]:
+            return None
+        k = self.names[i]
+        return self.mm[self.blob + self.offsets[k]:self.blob + self.offsets[k + 1]].decode('utf-8')
+
+
+class IPDatabase:
+    """
+    IPv4 -> location lookups against the range file at ``path``.
+
+    The file is opened lazily and re-opened when it is replaced (new inode, size
+    or mtime), which also drops the cached lookups; a missing or unreadable file
+    simply yields no results.
+    """
+
+    def __init__(self, path: str = IP_DB_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.current = None
+        self.key = None
+        self.checked = float('-inf')
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self.checked < IP_DB_CHECK_INTERVAL:
+            return self.current
+        with self.lock:
+            if now - self.checked < IP_DB_CHECK_INTERVAL:
+                return self.current
+            self.checked = now
+            try:
+                st = os.stat(self.path)
+                key = (st.st_ino, st.st_size, st.st_mtime_ns)
+                if key != self.key:
+                    # Readers still holding the old mapping keep it alive until they finish.
+                    self.current = _IPRangeFile(self.path)
+                    self.key = key
+                    _cache.clear()
+            except (OSError, ValueError):
+                self.current = None
+                self.key = None
+            return self.current
+
+    def lookup(self, ip: str):
+        """Return the location for an IPv4 address, or None if not covered."""
+        db = self._refresh()
+        value = _ipv4_to_int(ip) if db is not None else None
+        return db.lookup(value) if value is not None else None
+
+
+ip_database = IPDatabase()
+
+
+def ip_api_provider(ip: str):
+    """Resolve ``ip`` via ip-api.com. Returns 'country-region-city' or None."""
+    resp = requests.get(IP_API_URL.format(ip), timeout=IP_API_TIMEOUT)
+    if resp.status_code != 200:
+        return None
+    data = resp.json()
+    if data.get('status') != 'success':
+        return None
+    parts = (data.get('country', ''), data.get('regionName', ''), data.get('city', ''))
+    return '-'.join(p for p in parts if p) or None
+
+
+class _LocationCache:
+    """Thread-safe LRU of ``ip -> (expires_at, location)``; '' marks a failed lookup."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, ip):
+        """Return the cached location ('' if the last lookup failed) or None if unknown."""
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[ip]
+                return None
+            self.entries.move_to_end(ip)
+            return entry[1]
+
+    def put(self, ip, location) -> None:
+        ttl = LOCATION_TTL if location else LOCATION_FAIL_TTL
+        with self.lock:
+            self.entries[ip] = (time.monotonic() + ttl, location or '')
+            self.entries.move_to_end(ip)
+            while len(self.entries) > LOCATION_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+def default_provider(ip: str):
+    """Local range file first; ip-api.com only for misses and only if enabled."""
+    location = ip_database.lookup(ip)
+    if location is None and IP_API_FALLBACK:
+        location = ip_api_provider(ip)
+    return location
+
+
+_cache = _LocationCache()
+_provider = default_provider
+
+_queue = None
+_queue_pid = None
+_queued = set()
+_queue_lock = Lock()
+
+
+def set_location_provider(provider) -> None:
+    """
+    Replace the lookup backend. ``provider(ip)`` returns a location string or None
+    and may raise; it only ever runs on the background worker. Clears the cache.
+    """
+    global _provider
+    _provider = provider
+    _cache.clear()
+
+
+def _normalize_ip(ip_address):
+    """Return the first address of a (possibly forwarded) IP string, or None if unusable."""
+    if not ip_address:
+        return None
+    ip = ip_address.split(',')[0].strip()
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if addr.is_private or addr.is_loopback or addr.is_unspecified:
+        return None
+    return ip
+
+
+def cached_location(ip_address):
+    """Return the cached location for ``ip_address`` ('' if known-unresolvable) or None."""
+    ip = _normalize_ip(ip_address)
+    return _cache.get(ip) if ip else None
+
+
+def resolve_location(ip_address):
+    """Look ``ip_address`` up synchronously through the provider, caching the result."""
+    ip = _normalize_ip(ip_address)
+    if not ip:
+        return None
+    location = _cache.get(ip)
+    if location is None:
+        try:
+            location = _provider(ip) or ''
+        except Exception:
+            location = ''
+        _cache.put(ip, location)
+    return location or None
+
+
+def get_location_from_ip(ip_address, username=None):
+    """
+    Return the best location known right now, without any network call: the cached
+    lookup, else the local range file, else the user's stored location (kept even
+    if the IP changed, until the background lookup replaces it), else the IP. Call
+    queue_location_lookup afterwards to resolve misses through the fallback
+    provider and store the real location.
+    """
+    ip = _normalize_ip(ip_address)
+    location = _cache.get(ip) if ip else None
+    if location is None and ip:
+        location = ip_database.lookup(ip)
+        if location:
+            _cache.put(ip, location)
+    if location:
+        return location
+    if username:
+        user = get_user(username) or {}
+        if user.get('location'):
+            return user['location']
+    return ip_address
+
+
+def _get_queue() -> Queue:
+    """Return this process's lookup queue, starting its worker thread on first use."""
+    global _queue, _queue_pid
+    with _queue_lock:
+        if _queue is None or _queue_pid != os.getpid():
+            _queue = Queue(LOCATION_QUEUE_SIZE)
+            _queue_pid = os.getpid()
+            _queued.clear()
+            Thread(target=_worker, args=(_queue,), name='geo-lookup', daemon=True).start()
+        return _queue
+
+
+def _worker(queue: Queue) -> None:
+    while True:
+        username, ip_address = queue.get()
+        try:
+            _store_location(username, ip_address)
+        except Exception:
+            pass
+        finally:
+            with _queue_lock:
+                _queued.discard((username, ip_address))
+
+
+def _store_location(username: str, ip_address: str) -> None:
+    """Resolve and write the location back to the user if they still have that IP."""
+    location = resolve_location(ip_address)
+    if not location:
+        return
+
+    def mutate(info):
+        if info.get('ip_address') != ip_address or info.get('location') == location:
+            return None
+        return {'location': location}
+
+    modify_user(username, mutate)
+
+
+def queue_location_lookup(username: str, ip_address) -> bool:
+    """
+    Resolve ``ip_address`` in the background and store it as ``username``'s location.
+
+    The write is a single-row update that only applies while the user's stored IP
+    is still ``ip_address``, so call this after recording the login. Returns False
+    if nothing was queued: unusable IP, already cached (get_location_from_ip returned
+    it) or recently failed, duplicate request, or full queue.
+    """
+    if not username or not _normalize_ip(ip_address):
+        return False
+    if cached_location(ip_address) is not None:
+        return False
+    queue = _get_queue()
+    key = (username, ip_address)
+    with _queue_lock:
+        if key in _queued:
+            return False
+        _queued.add(key)
+    try:
+        queue.put_nowait(key)
+    except Full:
+        with _queue_lock:
+            _queued.discard(key)
+        return False
+    return True
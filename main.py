@@ -18,8 +18,13 @@ from datetime import datetime, timedelta
 from threading import Thread, Lock
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-from collections import defaultdict, deque
-from db_utils import init_db, load_users, save_users, db_lock
+from collections import OrderedDict, defaultdict
+import heapq
+import bisect
+import gevent
+from gevent.event import Event
+from db_utils import init_db, get_user, patch_user
+from geo_utils import get_location_from_ip, queue_location_lookup
 
 
 # 设置日志等级，隐藏 websocket 与 urllib3 的重复警告
@@ -61,9 +66,6 @@ CLOUD_AUTH_URL = f"{CLOUD_BASE_URL}/auth/login"
 CLOUD_LOGOUT_URL = f"{CLOUD_BASE_URL}/auth/logout"
 CLOUD_CHECK_URL = f"{CLOUD_BASE_URL}/psPlus/workflow/checkOnline"
 
-# 数据初始化函数（兼容旧实现）
-def load_local_users():
-    return load_users()
 # 前端获取ComfyUI地址，自动重置
 COMFYUI_URL = ""
 
@@ -97,50 +99,6 @@ def extract_client_ip(req):
         or req.remote_addr
     )
 
-#获取客户端归属地
-
-def get_location_from_ip(ip_address, username=None):
-    """根据IP地址获取地理位置信息（带 users.json 自动判断与写入）"""
-    if not ip_address or not username:
-        return ip_address  # 不处理匿名或空IP情况
-
-    # 从数据库读取用户信息
-    users = load_local_users()
-
-    user = users.get(username, {})
-    current_ip = user.get("ip_address")
-    current_loc = user.get("location", "")
-
-    # ✅ 如果 IP 未变化且 location 存在，直接返回缓存的
-    if current_ip == ip_address and current_loc:
-        return current_loc
-
-    # 🌐 否则调用外部 API 查询
-    try:
-        resp = requests.get(f"http://ip-api.com/json/{ip_address}?lang=zh-CN", timeout=3)
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get('status') == 'success':
-                country = data.get('country', '')
-                region = data.get('regionName', '')
-                city = data.get('city', '')
-                location = '-'.join([p for p in [country, region, city] if p])
-                if location:
-                    # 📝 写入用户信息并保存
-                    user['ip_address'] = ip_address
-                    user['location'] = location
-                    users[username] = user
-                    save_users(users)
-                    return location
-    except Exception:
-        pass
-
-    # fallback：失败时也更新IP，但保留旧location或空
-    user['ip_address'] = ip_address
-    users[username] = user
-    save_users(users)
-
-    return current_loc or ip_address
 #获取实时comfyui地址
 def is_remote_url(url: str) -> bool:
     """Return True if the given URL points to a public (non-local) address."""
@@ -180,12 +138,28 @@ def adapt_workflow_paths(workflow_data, comfyui_url: str):
 
 #websock
 comfyui_ws = None  
-message_queue = defaultdict(deque) 
+# client_id -> ClientLog：每个客户端一个带序号的消息环形缓冲
+client_logs = {}
+MESSAGE_LOG_SIZE = 100
+# 广播消息只存一份：共享环形缓冲 + 每个客户端的广播游标，读取时与私有消息合并
+BROADCAST_LOG_SIZE = 100
+client_broadcast_cursor = {}
+# 未带 after/since 的旧版轮询客户端：服务端记录的读取位置 (cursor, epoch)，已下发的消息不再重复返回
+client_read_cursor = {}
 task_status = {}  
 client_last_seen = {}  
 upload_progress = {}  
 queue_lock = Lock()  
 task_result_cache = {}
+# 长轮询：每个客户端一个 Event，新消息入队时只唤醒该客户端的等待请求
+client_events = {}
+# /api/poll 的 wait 参数上限（秒），需小于前端/反向代理的请求超时
+LONG_POLL_MAX_WAIT = 25
+# /ws 推送：client_id -> 已连接的订阅者集合；空闲心跳间隔（秒）
+# 慢客户端不另设缓冲：游标落后超过环形缓冲长度的消息计为丢弃
+ws_subscribers = defaultdict(set)
+WS_HEARTBEAT = 20
+ws_stats = {"connections": 0, "sent": 0, "dropped": 0}
 
 def start_progress_tracker_by_mapping(prompt_id, workflow_id, client_id, comfyui_url):
     comfyui_url = sanitize_url(comfyui_url)
@@ -218,6 +192,12 @@ def start_progress_tracker_by_mapping(prompt_id, workflow_id, client_id, comfyui
                 history_data = data[prompt_id]
                 status = history_data.get("status", {})
 
+                # 任务已结束（历史记录显示完成/出错，或客户端已收到结束事件）：不再推送
+                # executing/progress，避免在结束事件之后出现“仍在执行”的消息
+                if status.get("status_str") in ["success", "error"] or prompt_finished(client_id, prompt_id):
+                    logger.info(f"📈 任务已结束，停止进度跟踪: {prompt_id}")
+                    break
+
                 outputs = history_data.get("outputs", {})
                 current_node = len(outputs)
 
@@ -254,7 +234,7 @@ def start_progress_tracker_by_mapping(prompt_id, workflow_id, client_id, comfyui
                         "sampler_steps":  sampler_steps
                     }
                 })
-                if current_node >= total_nodes or status.get("status_str") in ["success", "error"]:
+                if current_node >= total_nodes:
                     print()  # 完成后换行
                     logger.info(f"📈 进度更新: {percent}% [节点 {current_node}/{total_nodes}]")
                     break
@@ -264,55 +244,285 @@ def start_progress_tracker_by_mapping(prompt_id, workflow_id, client_id, comfyui
                 time.sleep(1)
 
 
-def add_message_to_queue(client_id, message):
-   
-    with queue_lock:
-    
-        if len(message_queue[client_id]) > 100:
-            message_queue[client_id].popleft()
-     
-        enhanced_message = {
-            "id": str(uuid.uuid4())[:8],
+# 同一 prompt_id 的此类消息只保留最新一条（新消息取代旧消息）
+COALESCE_TYPES = ("progress", "executing")
+# 终态事件：不占普通消息容量，另有 TERMINAL_LOG_SIZE 条独立额度，进度/状态消息再多也挤不掉；
+# 未读终态事件超出该额度时才挤出最早的一条，并计入 lost/dropped
+TERMINAL_TYPES = ("task_submitted", "executed", "execution_success", "execution_error",
+                  "execution_interrupted")
+TERMINAL_LOG_SIZE = 100
+# 表示 prompt 执行结束的事件类型（另有 node 为空的 executing）
+FINISH_TYPES = ("execution_success", "execution_error", "execution_interrupted")
+# 记录被挤出消息序号的数量（容量的倍数），用于计算游标之后的丢失条数
+EVICTED_TRACK = 10
+
+
+def _coalesce_key(message):
+    if message.get("type") in COALESCE_TYPES:
+        data = message.get("data") or {}
+        if data.get("prompt_id"):
+            return message["type"], data["prompt_id"]
+    return None
+
+
+def _is_finished(message):
+    if message.get("type") == "executing":
+        return (message.get("data") or {}).get("node") is None
+    return message.get("type") in FINISH_TYPES
+
+
+def _is_terminal(message):
+    msg_type = message.get("type")
+    if msg_type == "executing":
+        # ComfyUI 以 node 为空的 executing 表示该 prompt 执行结束
+        return (message.get("data") or {}).get("node") is None
+    return msg_type in TERMINAL_TYPES
+
+
+class ClientLog:
+    """
+    单个客户端的消息日志：按序号（从1单调递增）排列。
+    - 普通消息最多 size 条，终态事件（task_submitted、executed 等）另有 terminal_size 条额度，
+      两者各自挤出本类最早的一条，终态事件不会被进度/状态消息刷掉；
+    - 同一 prompt_id 的 progress/executing 新消息取代旧消息：旧条目移除，新条目以新序号追加，
+      游标已越过旧位置的读者也能收到更新；终态事件既不取代其它消息，也不会被取代；
+    - 按游标读取用二分定位，只取游标之后的 k 条。
+    epoch 标识本日志实例，日志被清理重建后客户端可据此发现游标失效。
+    """
+
+    def __init__(self, size=None, terminal_size=None):
+        self.size = size or MESSAGE_LOG_SIZE
+        self.terminal_size = terminal_size or TERMINAL_LOG_SIZE
+        self.terminals = 0
+        # 最近已结束的 prompt_id（有序，最多 terminal_size 个），供进度跟踪判断是否停止
+        self.finished = OrderedDict()
+        self.entries = []
+        self.seqs = []
+        self.latest = {}
+        self.evicted = []
+        self.evicted_total = 0
+        self.last = 0
+        self.epoch = uuid.uuid4().hex[:8]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, entry):
+        i = bisect.bisect_left(self.seqs, entry["seq"])
+        del self.seqs[i], self.entries[i]
+        if _is_terminal(entry["data"]):
+            self.terminals -= 1
+
+    def append(self, message):
+        self.last += 1
+        entry = {
+            "id": f"{self.epoch}-{self.last}",
+            "seq": self.last,
             "timestamp": time.time(),
             "data": message
         }
-        
-        message_queue[client_id].append(enhanced_message)
+        terminal = _is_terminal(message)
+        key = None if terminal else _coalesce_key(message)
+        if key is not None:
+            previous = self.latest.get(key)
+            if previous is not None and not _is_terminal(previous["data"]):
+                self._remove(previous)
+            self.latest[key] = entry
+        if _is_finished(message):
+            prompt_id = (message.get("data") or {}).get("prompt_id")
+            if prompt_id:
+                self.finished[prompt_id] = True
+                self.finished.move_to_end(prompt_id)
+                if len(self.finished) > self.terminal_size:
+                    self.finished.popitem(last=False)
+        self.entries.append(entry)
+        self.seqs.append(self.last)
+        if terminal:
+            self.terminals += 1
+            if self.terminals > self.terminal_size:
+                self._evict(terminal=True)
+        elif len(self.entries) - self.terminals > self.size:
+            self._evict(terminal=False)
+        return entry
+
+    def _evict(self, terminal):
+        """挤出最早的一条终态（terminal=True）或普通消息，记入丢失"""
+        victim = next(e for e in self.entries if _is_terminal(e["data"]) == terminal)
+        self._remove(victim)
+        key = _coalesce_key(victim["data"])
+        if key is not None and self.latest.get(key) is victim:
+            del self.latest[key]
+        bisect.insort(self.evicted, victim["seq"])
+        if len(self.evicted) > EVICTED_TRACK * self.size:
+            del self.evicted[0]
+        self.evicted_total += 1
+
+    def read(self, after=None, epoch=None):
+        """
+        读取序号大于 after 的消息。
+        返回 (消息列表, 丢失条数, 是否重置)：游标之后被挤出的消息计入丢失（被取代的进度不算，
+        只记最近 EVICTED_TRACK 倍容量的挤出，落后更多时为下限）；
+        epoch 不符或游标超前（日志已重建）时视为重置，从最早保留的消息读起。
+        """
+        reset = after is not None and ((epoch and epoch != self.epoch) or after > self.last)
+        if after is None or reset:
+            return list(self.entries), (self.evicted_total if reset else 0), reset
+        start = bisect.bisect_right(self.seqs, after)
+        lost = len(self.evicted) - bisect.bisect_right(self.evicted, after)
+        return self.entries[start:], lost, False
+
+
+broadcast_log = ClientLog(BROADCAST_LOG_SIZE)
+# 每次广播 set 后换新：等待者同时等自己的 Event 和当前广播 Event，发布代价与客户端数无关
+broadcast_event = Event()
+
+
+def prompt_finished(client_id, prompt_id):
+    """客户端日志中是否已有该 prompt 的结束事件"""
+    with queue_lock:
+        log = client_logs.get(client_id)
+        return log is not None and prompt_id in log.finished
+
+
+def add_message_to_queue(client_id, message):
+   
+    with queue_lock:
+        log = client_logs.get(client_id)
+        if log is None:
+            log = client_logs[client_id] = ClientLog()
+        log.append(message)
+        event = client_events.get(client_id)
+        if event is not None:
+            event.set()
+        for subscriber in ws_subscribers.get(client_id, ()):
+            subscriber.event.set()
         logger.info(f"📨 消息已添加到客户端队列: {client_id} (类型: {message.get('type', 'unknown')})")
 
-def get_messages_for_client(client_id, since_timestamp=None):
-    
+class WsSubscriber:
+    """一个 /ws 连接：记录已发送到的游标，有新消息时被唤醒"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.event = Event()
+        self.cursor = None
+        self.epoch = None
+        self.broadcast_cursor = None
+        self.broadcast_event = broadcast_event
+        self.closed = False
+
+    def wait(self, timeout):
+        """等待私有消息或广播，任一到达返回 True，超时返回 False"""
+        return bool(gevent.wait([self.event, self.broadcast_event], timeout=timeout, count=1))
+
+    def drain(self):
+        """读取游标之后的消息并前移游标；若有消息被覆盖，先附一条 dropped 通知"""
+        # 先取广播 Event 再读，读之后的广播一定会唤醒下一次 wait
+        self.broadcast_event = broadcast_event
+        result = get_messages_for_client(
+            self.client_id, self.cursor, epoch=self.epoch, broadcast_after=self.broadcast_cursor
+        )
+        self.cursor, self.epoch = result["cursor"], result["epoch"]
+        self.broadcast_cursor = result["broadcast_cursor"]
+        messages = result["messages"]
+        if result["lost"]:
+            ws_stats["dropped"] += result["lost"]
+            messages.insert(0, {"type": "dropped", "count": result["lost"], "timestamp": time.time()})
+        return messages
+
+def subscribe_ws(client_id, after=None, epoch=None):
+    """登记 /ws 订阅者，并返回 after 之后已有的消息（与后续推送不重不漏）"""
+    subscriber = WsSubscriber(client_id)
+    subscriber.cursor, subscriber.epoch = after, epoch
+    with queue_lock:
+        ws_subscribers[client_id].add(subscriber)
+        ws_stats["connections"] += 1
+    return subscriber, subscriber.drain()
+
+def unsubscribe_ws(subscriber):
+    with queue_lock:
+        subscribers = ws_subscribers.get(subscriber.client_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del ws_subscribers[subscriber.client_id]
+        ws_stats["connections"] -= 1
+
+def get_client_event(client_id):
+    """返回客户端的长轮询 Event（不存在则创建）"""
+    with queue_lock:
+        event = client_events.get(client_id)
+        if event is None:
+            event = client_events[client_id] = Event()
+        return event
+
+def wait_messages_for_client(client_id, after=None, since_timestamp=None, epoch=None,
+                             broadcast_after=None, wait=0):
+    """
+    读取客户端消息；无消息时最多挂起 wait 秒，直到有新消息入队或广播。
+    after 与 since 都未给出（旧版客户端）时从服务端记录的读取位置续读，
+    已返回的消息不再重复下发，长轮询也能在无新消息时挂起。
+    """
+    legacy = after is None and since_timestamp is None
+    if legacy:
+        with queue_lock:
+            after, epoch = client_read_cursor.get(client_id, (0, None))
+    if wait <= 0:
+        result = get_messages_for_client(client_id, after, since_timestamp, epoch, broadcast_after)
+    else:
+        event = get_client_event(client_id)
+        # 先清除（并取当前广播 Event）再读取，读取之后入队或广播的消息一定会唤醒下面的 wait
+        event.clear()
+        shared = broadcast_event
+        result = get_messages_for_client(client_id, after, since_timestamp, epoch, broadcast_after)
+        if not result["messages"] and gevent.wait([event, shared], timeout=wait, count=1):
+            result = get_messages_for_client(
+                client_id, result["cursor"], epoch=result["epoch"],
+                broadcast_after=result["broadcast_cursor"]
+            )
+    if legacy:
+        with queue_lock:
+            client_read_cursor[client_id] = (result["cursor"], result["epoch"])
+    return result
+
+def get_messages_for_client(client_id, after=None, since_timestamp=None, epoch=None,
+                            broadcast_after=None):
+    """
+    按游标读取客户端消息。after 为上次返回的 cursor；未给出时兼容旧的 since 时间戳过滤。
+    广播消息按 broadcast_after 读取，未给出时使用服务端为该客户端记录的广播游标
+    （首次出现时从当前位置开始，不补发之前的广播），按时间与私有消息合并。
+    返回 {"messages", "cursor", "epoch", "lost", "reset", "broadcast_cursor"}，
+    lost>0 表示游标之后有消息已被覆盖。
+    """
     with queue_lock:
         client_last_seen[client_id] = time.time()
-        
-        if client_id not in message_queue:
-            return []
-        
-        messages = []
-        for msg in message_queue[client_id]:
-            if since_timestamp is None or msg["timestamp"] > since_timestamp:
-                messages.append(msg)
-        
-        # 清理已读消息（保留最近20条）
-        if len(messages) > 0:
-            message_queue[client_id] = deque(list(message_queue[client_id])[-20:])
-        
-        return messages
+        if broadcast_after is None:
+            broadcast_after = client_broadcast_cursor.get(client_id, broadcast_log.last)
+        shared, shared_lost, _ = broadcast_log.read(broadcast_after)
+        client_broadcast_cursor[client_id] = broadcast_log.last
+        result = {"broadcast_cursor": broadcast_log.last}
+        log = client_logs.get(client_id)
+        if log is None:
+            messages, lost = [], 0
+            result.update(cursor=0, epoch=None, reset=bool(after and epoch))
+        else:
+            messages, lost, reset = log.read(after, epoch)
+            result.update(cursor=log.last, epoch=log.epoch, reset=reset)
+    if after is None and since_timestamp is not None:
+        messages = [msg for msg in messages if msg["timestamp"] > since_timestamp]
+    if shared:
+        messages = list(heapq.merge(messages, shared, key=lambda msg: msg["timestamp"]))
+    result.update(messages=messages, lost=lost + shared_lost)
+    return result
 
 def broadcast_message(message):
-   
-    current_time = time.time()
-    active_clients = []
-    
+    """向所有客户端广播：只写入共享广播缓冲一次，并唤醒所有等待中的连接"""
+    global broadcast_event
     with queue_lock:
-        # 找出活跃客户端（最近5分钟内有活动）
-        for client_id, last_seen in client_last_seen.items():
-            if current_time - last_seen < 300:  # 5分钟
-                active_clients.append(client_id)
-    
-
-    for client_id in active_clients:
-        add_message_to_queue(client_id, message)
+        entry = broadcast_log.append(message)
+        entry["broadcast"] = True
+        event, broadcast_event = broadcast_event, Event()
+    event.set()
+    logger.info(f"📢 广播消息 (类型: {message.get('type', 'unknown')})")
 
 def cleanup_inactive_clients():
 
@@ -326,10 +536,12 @@ def cleanup_inactive_clients():
         
         for client_id in inactive_clients:
             del client_last_seen[client_id]
-            if client_id in message_queue:
-                del message_queue[client_id]
+            client_logs.pop(client_id, None)
+            client_broadcast_cursor.pop(client_id, None)
+            client_read_cursor.pop(client_id, None)
             if client_id in upload_progress:
                 del upload_progress[client_id]
+            client_events.pop(client_id, None)
     
     if inactive_clients:
         logger.info(f"🧹 清理了 {len(inactive_clients)} 个非活跃客户端")
@@ -789,26 +1001,42 @@ COMFYUI_URL = sanitize_url(proxy.config.get("comfyui_url", ""))
 #打印所有请求的调试接口
 @app.before_request
 def log_all_requests():
+    # 轮询请求频繁，只记 debug 日志
+    if request.path == '/api/poll':
+        logger.debug(f"📡 收到插件接口请求: {request.method} {request.path}")
+        return
     logger.info(f"📡 收到插件接口请求: {request.method} {request.path}")
 
 # 处理跨域请求
 @app.route('/api/poll', methods=['GET'])
 def poll_messages():
-
-    logger.info("⚠️存在跨域请求")
+    """
+    拉取客户端消息。after/epoch 为上次响应中的 cursor/epoch，只返回之后的消息；
+    lost>0 表示其间有消息已被覆盖，reset 表示游标已失效（服务重启或队列被清理）。
+    未给出 after 时兼容旧的 since 时间戳过滤；两者都未给出时按服务端记录的读取位置续读，
+    每条消息只返回一次。
+    广播消息合并在 messages 中（带 broadcast 标记），可用 broadcast_after 指定广播游标续读。
+    wait>0 时为长轮询：无消息则挂起直到有新消息或超时，
+    wait 缺省取配置 poll_wait（默认0，立即返回），上限 LONG_POLL_MAX_WAIT 秒。
+    """
     client_id = request.args.get('clientId')
+    after = request.args.get('after', type=int)
+    epoch = request.args.get('epoch')
+    broadcast_after = request.args.get('broadcast_after', type=int)
     since_timestamp = request.args.get('since', type=float)
+    wait = request.args.get('wait', proxy.config.get('poll_wait', 0), type=float)
+    wait = min(max(wait or 0, 0), LONG_POLL_MAX_WAIT)
     
     if not client_id:
         return jsonify({"error": "缺少clientId参数"}), 400
     
     try:
-        messages = get_messages_for_client(client_id, since_timestamp)
+        result = wait_messages_for_client(client_id, after, since_timestamp, epoch, broadcast_after, wait)
         
 
         extra_info = {
             "active_tasks": len(task_status),
-            "queue_size": len(message_queue.get(client_id, [])),
+            "queue_size": len(client_logs.get(client_id, ())),
             "server_time": time.time()
         }
         
@@ -816,7 +1044,12 @@ def poll_messages():
             "code": 0,
             "msg": "success",
             "data": {
-                "messages": messages,
+                "messages": result["messages"],
+                "cursor": result["cursor"],
+                "epoch": result["epoch"],
+                "lost": result["lost"],
+                "reset": result["reset"],
+                "broadcast_cursor": result["broadcast_cursor"],
                 "timestamp": time.time(),
                 "clientId": client_id,
                 "extra_info": extra_info
@@ -1047,10 +1280,9 @@ def huiying_commit():
 
 from flask import request
 import json
-import gevent
 import time
 # WebSocket 代理
-@app.route("/ws")
+@app.route("/ws", websocket=True)  # Werkzeug 只把升级请求匹配到 websocket 规则
 def proxy_ws():
     ws = request.environ.get("wsgi.websocket")
     if not ws:
@@ -1059,27 +1291,53 @@ def proxy_ws():
 
     client_id = request.args.get("clientId") or request.headers.get("Clientid")
     if not client_id:
-        logger.warning("❌ 未提供 clientId，无法建立伪 WebSocket 轮询")
+        logger.warning("❌ 未提供 clientId，无法建立 WebSocket 推送")
         ws.close()
-        return
+        return ""
 
 
-    try:
-        while True:
-            msgs = get_messages_for_client(client_id)
+    # 断线重连时带上 after/epoch（最后收到消息的 seq 与 id 前缀）可续传
+    subscriber, backlog = subscribe_ws(
+        client_id, request.args.get("after", type=int), request.args.get("epoch")
+    )
 
-            if not msgs:
-                logger.debug(f"🕐 [client {client_id}] 当前无新消息")
-            else:
-                for msg in msgs:
-                    ws.send(json.dumps(msg))
-                    logger.info(f"📤 [client {client_id}] 已转发消息: {msg}")
+    def reader():
+        # 读取客户端帧（含关闭帧），连接断开时唤醒发送循环
+        try:
+            while ws.receive() is not None:
+                pass
+        except Exception:
+            pass
+        subscriber.closed = True
+        subscriber.event.set()
 
-            gevent.sleep(1)  
+    reader_greenlet = gevent.spawn(reader)
+    try:
+        for msg in backlog:
+            ws.send(json.dumps(msg))
+        ws_stats["sent"] += len(backlog)
+        while not subscriber.closed:
+            # 先清除再取，取之后推送的消息一定会再次唤醒
+            woken = subscriber.wait(WS_HEARTBEAT)
+            subscriber.event.clear()
+            client_last_seen[client_id] = time.time()
+            if subscriber.closed:
+                break
+            if not woken:
+                ws.send(json.dumps({"type": "ping", "timestamp": time.time()}))
+                continue
+            msgs = subscriber.drain()
+            for msg in msgs:
+                ws.send(json.dumps(msg))
+            ws_stats["sent"] += len(msgs)
+            logger.debug(f"📤 [client {client_id}] 已推送 {len(msgs)} 条消息")
     except Exception as e:
         logger.warning(f"⚠️ WebSocket 异常: {e}")
     finally:
+        unsubscribe_ws(subscriber)
+        reader_greenlet.kill(block=False)
         ws.close()
+    return ""
 # 更新 ComfyUI URL 接口
 @app.route('/api/config/comfyui_url', methods=['POST'])
 def update_comfyui_url():
@@ -1174,7 +1432,8 @@ def health_check():
         "service": "huiying-proxy-enhanced-fixed",
         "version": "2.5.0",
         "timestamp": datetime.now().isoformat(),
-        "features": ["http_polling", "task_status", "message_queue", "enhanced_progress", "upload_progress", "mask_support"]
+        "features": ["http_polling", "task_status", "message_queue", "enhanced_progress", "upload_progress", "mask_support"],
+        "ws": dict(ws_stats)
     })
 
 
@@ -1191,8 +1450,7 @@ def login_compatible():
 
     #logger.info("🔑 [Login] 收到登录请求，用户名: %s", username)
 
-    users = load_local_users()
-    user = users.get(username)
+    user = get_user(username) if username else None
 
     if isinstance(user, dict):
         user_password = user.get("password")
@@ -1212,18 +1470,19 @@ def login_compatible():
         }
         save_sessions(sessions)
 
-        users_data = load_local_users()
-        nickname = users_data.get(username, {}).get("nickname", "")
+        nickname = user.get("nickname", "") if isinstance(user, dict) else ""
     
         logger.info(f"👤 用户: {username}-「{nickname}」登录成功")
-        # 更新 last_login 字段
+        # 更新 last_login 字段（仅写入该用户一行）
         try:
-            users_json = load_local_users()
-            if username in users_json:
-                users_json[username]["last_login"] = time.strftime("%Y-%m-%d %H:%M:%S")
-                users_json[username]["ip_address"] = extract_client_ip(request)
-                users_json[username]["location"] = get_location_from_ip(users_json[username]["ip_address"], username)
-                save_users(users_json)
+            client_ip = extract_client_ip(request)
+            patch_user(username, {
+                "last_login": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "ip_address": client_ip,
+                "location": get_location_from_ip(client_ip, username),
+            })
+            # 归属地在后台查询后单行回写，不阻塞登录
+            queue_location_lookup(username, client_ip)
         except Exception as e:
             logger.warning(f"[Login] 无法写入最后登录时间: {e}")
         return jsonify({
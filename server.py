@@ -5,17 +5,36 @@
 # 各部分函数均有详细注释，说明用途、流程、交互及异常处理。
 # 导入标准库及所需第三方库
 import os
+import csv
 import json
+import time
 import inspect
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-import requests
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, StringIO
 from functools import wraps
-from db_utils import init_db, load_users, save_users, db_lock
+from db_utils import (
+    init_db, iter_users,
+    get_user, patch_user, modify_user, rename_user, remove_user, page_users,
+    create_users, create_generated_users, insert_user, allocate_user_ids, suggest_users,
+    add_ledger_record, query_ledger, ledger_revenue, import_ledger_json,
+    ledger_rollup, rebuild_ledger_rollups, rebuild_user_search, pending_counts,
+    create_application, list_applications, patch_application,
+    approve_applications, reject_applications, import_applications_json,
+    existing_usernames, create_job, update_job, get_job, list_jobs, add_job_rejects, iter_job_rejects,
+    touch_jobs, fail_stale_jobs,
+    page_bulk_accounts, iter_bulk_accounts, batch_update_users,
+)
+from geo_utils import get_location_from_ip, queue_location_lookup, build_ip_database, IP_DB_PATH
 
 # 导入Flask及相关工具
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, jsonify
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, send_file, jsonify,
+    Response, stream_with_context,
+)
 from werkzeug.utils import secure_filename
 
 # Excel文件处理库
@@ -24,9 +43,12 @@ from openpyxl import Workbook, load_workbook
 # 基础目录及数据文件路径
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 init_db()
-LEDGER_FILE = os.path.join(BASE_DIR, 'ledger.json')        # 台账数据文件
+LEDGER_FILE = os.path.join(BASE_DIR, 'ledger.json')        # 旧版台账文件，仅用于首次导入数据库
+import_ledger_json(LEDGER_FILE)
 PRODUCTS_FILE = os.path.join(BASE_DIR, 'products.json')    # 产品数据文件
-APPLICATIONS_FILE = os.path.join(BASE_DIR, 'applications.json') # 审批数据文件
+APPLICATIONS_FILE = os.path.join(BASE_DIR, 'applications.json') # 旧版审批文件，仅用于首次导入数据库
+import_applications_json(APPLICATIONS_FILE)
+fail_stale_jobs()                                           # 进程已退出的遗留任务标记为失败
 
 # Flask应用初始化及密钥设置
 app = Flask(__name__)
@@ -35,50 +57,6 @@ app.secret_key = os.environ.get('SECRET_KEY', 'huiying-secret')  # 用户身份
 
 
 
-def get_location_from_ip(ip_address, username=None):
-    """根据IP地址获取地理位置信息（带 users.json 自动判断与写入）"""
-    if not ip_address or not username:
-        return ip_address  # 不处理匿名或空IP情况
-
-    # 从数据库读取用户信息
-    users = load_users()
-
-    user = users.get(username, {})
-    current_ip = user.get("ip_address")
-    current_loc = user.get("location", "")
-
-    # ✅ 如果 IP 未变化且 location 存在，直接返回缓存的
-    if current_ip == ip_address and current_loc:
-        return current_loc
-
-    # 🌐 否则调用外部 API 查询
-    try:
-        resp = requests.get(f"http://ip-api.com/json/{ip_address}?lang=zh-CN", timeout=3)
-        if resp.status_code == 200:
-            data = resp.json()
-            if data.get('status') == 'success':
-                country = data.get('country', '')
-                region = data.get('regionName', '')
-                city = data.get('city', '')
-                location = '-'.join([p for p in [country, region, city] if p])
-                if location:
-                    # 📝 写入用户信息并保存
-                    user['ip_address'] = ip_address
-                    user['location'] = location
-                    users[username] = user
-                    save_users(users)
-                    return location
-    except Exception:
-        pass
-
-    # fallback：失败时也更新IP，但保留旧location或空
-    user['ip_address'] = ip_address
-    users[username] = user
-    save_users(users)
-
-    return current_loc or ip_address
-
-
 def get_client_ip():
     """获取客户端真实IP地址
     用途：兼容代理环境下获取用户真实IP，优先X-Forwarded-For，再X-Real-IP，否则取remote_addr。
@@ -91,55 +69,26 @@ def get_client_ip():
         return request.remote_addr
 
 
-def generate_user_id(users: dict) -> str:
+def generate_user_id() -> str:
     """
     生成唯一用户编号。编号格式为当前时间戳+三位序号，确保唯一性。
-    参数:
-        users: 当前所有用户字典，用于检测已存在编号。
+    由数据库序列表原子分配（按块预留），多进程安全，无需扫描用户表。
     返回:
         新的用户编号字符串。
     """
-    ts = datetime.now().strftime('%Y%m%d%H%M%S')
-    seq = 1
-    for u in users.values():
-        uid = str(u.get('user_id', ''))
-        if uid.startswith(ts):
-            try:
-                num = int(uid[len(ts):])
-                if num >= seq:
-                    seq = num + 1
-            except Exception:
-                continue
-    return f"{ts}{seq:03d}"
-
-
-# 用户数据的读写由 db_utils 提供
+    return allocate_user_ids(1)[0]
 
 
-def load_ledger() -> list:
+def random_credentials():
     """
-    加载台账记录列表，自动补全role字段。
-    用途：用于收入、销售等统计与显示。
-    异常：文件不存在/损坏时返回空列表。
+    生成一组随机用户名与密码。
+    返回:
+        (用户名, 密码) 元组，用户名格式为 huiying + 5位十六进制。
     """
-    if os.path.exists(LEDGER_FILE):
-        with open(LEDGER_FILE, 'r', encoding='utf-8') as f:
-            try:
-                records = json.load(f).get('records', [])
-                for r in records:
-                    r.setdefault('role', 'admin')
-                return records
-            except Exception:
-                return []
-    return []
+    return f"huiying{os.urandom(4).hex()}"[:12], os.urandom(4).hex()
 
 
-def save_ledger(records: list) -> None:
-    """
-    保存台账记录到文件。
-    """
-    with open(LEDGER_FILE, 'w', encoding='utf-8') as f:
-        json.dump({'records': records}, f, indent=4, ensure_ascii=False)
+# 用户数据的读写由 db_utils 提供
 
 
 def load_products() -> dict:
@@ -169,43 +118,14 @@ def save_products(products: dict) -> None:
         json.dump({'products': products}, f, indent=4, ensure_ascii=False)
 
 
-def load_applications() -> list:
-    """
-    加载代理批量申请记录列表。
-    用途：审批管理。
-    异常：文件不存在/损坏时返回空列表。
-    """
-    if os.path.exists(APPLICATIONS_FILE):
-        with open(APPLICATIONS_FILE, 'r', encoding='utf-8') as f:
-            try:
-                return json.load(f).get('apps', [])
-            except Exception:
-                return []
-    return []
-
-
-def save_applications(apps: list) -> None:
-    """
-    保存代理批量申请记录到文件。
-    """
-    with open(APPLICATIONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump({'apps': apps}, f, indent=4, ensure_ascii=False)
-
-
 @app.context_processor
 def inject_counts():
     """
     模板上下文处理器：为模板提供待审批/待申请数量。
     用途：页面角标、提示等。
+    交互：只读取由申请表触发器维护的计数（一次主键查询），不读取申请数据。
     """
-    apps = load_applications()
-    pending_admin = sum(1 for a in apps if a.get('status') == 'pending')
-    pending_agent = 0
-    if session.get('agent'):
-        pending_agent = sum(
-            1 for a in apps
-            if a.get('agent') == session.get('agent') and a.get('status') == 'pending'
-        )
+    pending_admin, pending_agent = pending_counts(session.get('agent'))
     return dict(
         pending_approve_count=pending_admin,
         pending_apply_count=pending_agent,
@@ -251,16 +171,17 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
-        users = load_users()
-        user = users.get(username)
+        user = get_user(username) if username else None
         if user and user.get('password') == password:
-            # 登录成功，记录登录时间和来源IP
+            # 登录成功，记录登录时间和来源IP（仅更新该用户）
             client_ip = get_client_ip()
-            user['last_login'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            user['ip_address'] = client_ip
-            user['location'] = get_location_from_ip(client_ip)
-            users[username] = user
-            save_users(users)
+            user = patch_user(username, {
+                'last_login': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'ip_address': client_ip,
+                'location': get_location_from_ip(client_ip, username),
+            }) or user
+            # 归属地在后台查询后单行回写，不阻塞登录
+            queue_location_lookup(username, client_ip)
             if user.get('is_admin'):
                 session['admin'] = username
                 return redirect(url_for('user_list'))
@@ -297,25 +218,41 @@ def bulk_manage():
     """
     批量操作管理页面，显示最近批量创建的账户信息。
     用途：批量导出、回显等。
-    交互：读取会话中的批量账户列表。
+    交互：会话只保存批次号（任务ID），账户按页从数据库读取；任务进行中时显示进度。
     """
-    accounts = session.get('bulk_accounts')
-    info = session.get('bulk_info')
+    job, batch, info = _bulk_batch()
     products = load_products()
     page = int(request.args.get('page', 1))
     per_page = 20
-    if accounts:
-        start = (page - 1) * per_page
-        page_accounts = accounts[start:start + per_page]
-    else:
-        page_accounts = None
+    accounts, total = page_bulk_accounts(batch, page, per_page) if batch else (None, 0)
     return render_template(
-        'bulk.html', accounts=page_accounts, products=products,
-        info=info, page=page, per_page=per_page,
-        total=len(accounts) if accounts else 0
+        'bulk.html', accounts=accounts, products=products,
+        info=info, page=page, per_page=per_page, total=total, job=job
     )
 
 
+def _bulk_batch() -> tuple:
+    """
+    读取会话中最近一次批量开通任务。
+    返回:
+        (任务, 批次号, 批次信息)；批次号即任务ID，任务失败或仍在进行时
+        已提交的账号同样可分页查看与导出；无任务时均为 None。
+    """
+    job = get_job(session['bulk_job']) if session.get('bulk_job') else None
+    if not job:
+        return None, None, None
+    if job.get('result'):
+        return job, job['result'].get('batch', job['id']), job['result'].get('info')
+    params = job.get('params') or {}
+    info = {
+        'product': params.get('product', ''),
+        'price': params.get('price', 0),
+        'admin': job.get('owner'),
+        'time': job.get('created_at')
+    }
+    return job, job['id'], info
+
+
 @app.route('/users/random')
 @admin_required
 def random_account():
@@ -323,48 +260,103 @@ def random_account():
     随机生成一个未占用的用户名及密码。
     用途：前端快速生成新用户账号。
     """
-    users = load_users()
     while True:
-        uname = f"huiying{os.urandom(4).hex()}"[:12]
-        if uname not in users:
+        uname, pwd = random_credentials()
+        if get_user(uname) is None:
             break
-    pwd = os.urandom(4).hex()
     return jsonify({'username': uname, 'password': pwd})
 
 
+def _download_kwargs(filename: str) -> dict:
+    """
+    兼容不同Flask版本的下载文件名参数。
+    """
+    if 'download_name' in inspect.signature(send_file).parameters:
+        return {'download_name': filename}
+    return {'attachment_filename': filename}
+
+
+def send_xlsx(filename: str, header: list, rows):
+    """
+    以 openpyxl 只写模式逐行生成Excel并下载。
+    用途：大数据量导出，内存占用不随行数增长。
+    交互：行数据直接写入临时文件（xlsx 为 zip 格式，需写完后整体发送），
+          发送时按块读取，响应结束后临时文件自动删除。
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    tmp = tempfile.TemporaryFile()
+    wb.save(tmp)
+    tmp.seek(0)
+    return send_file(
+        tmp,
+        as_attachment=True,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        **_download_kwargs(filename)
+    )
+
+
+def stream_csv(filename: str, header: list, rows):
+    """
+    边查询边输出CSV下载，首字节无需等待全部数据。
+    用途：大数据量导出的流式版本（带BOM，Excel可直接打开中文）。
+    """
+    def generate():
+        buf = StringIO()
+        writer = csv.writer(buf)
+        buf.write('\ufeff')
+        writer.writerow(header)
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % 500 == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+def user_filter_args() -> dict:
+    """
+    从请求参数解析用户列表筛选条件（列表页与导出共用）。
+    返回:
+        可直接传给 page_users/iter_users 的关键字参数。
+    """
+    status = request.args.get('status', '')
+    sale = request.args.get('sale', '')
+    return dict(
+        q=request.args.get('q', ''),
+        source=request.args.get('source', ''),
+        start=request.args.get('start', ''),
+        end=request.args.get('end', ''),
+        enabled=(status == 'enabled') if status else None,
+        forsale=(sale == 'forsale') if sale else None,
+    )
+
+
 @app.route('/bulk/export')
 @admin_required
 def bulk_export():
     """
-    导出最近一次批量创建的账户为Excel文件。
+    导出最近一次批量创建的账户为Excel文件（format=csv 时导出CSV）。
     用途：管理员批量导出分发。
-    交互：从session获取账户列表，生成Excel并下载。
+    交互：按会话中的批次号从数据库逐行读取账户并写出下载。
     """
-    accounts = session.get('bulk_accounts')
-    if not accounts:
+    _, batch, _ = _bulk_batch()
+    if not batch:
         return redirect(url_for('bulk_manage'))
-    wb = Workbook()
-    ws = wb.active
-    ws.append(['用户名', '密码'])
-    for acc in accounts:
-        ws.append([acc['username'], acc['password']])
-    bio = BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    # 兼容不同Flask版本的下载参数
-    filename = 'bulk_accounts.xlsx'
-    kwargs = {}
-    if 'download_name' in inspect.signature(send_file).parameters:
-        kwargs['download_name'] = filename
-    else:
-        kwargs['attachment_filename'] = filename
-    response = send_file(
-        bio,
-        as_attachment=True,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        **kwargs
-    )
-    return response
+    rows = iter_bulk_accounts(batch)
+    if request.args.get('format') == 'csv':
+        return stream_csv('bulk_accounts.csv', ['用户名', '密码'], rows)
+    return send_xlsx('bulk_accounts.xlsx', ['用户名', '密码'], rows)
 
 
 @app.route('/users')
@@ -384,30 +376,11 @@ def user_list():
     end = request.args.get('end', '')
     page = int(request.args.get('page', 1))
     per_page = max(int(request.args.get('per_page', 10)), 1)
-    users = load_users()
-    # 多条件筛选
-    if query:
-        users = {k: v for k, v in users.items() if query.lower() in k.lower()}
-    if source:
-        users = {k: v for k, v in users.items() if v.get('source') == source}
-    if status:
-        flag = status == 'enabled'
-        users = {k: v for k, v in users.items() if v.get('enabled', True) == flag}
-    if sale:
-        flag = sale == 'forsale'
-        users = {k: v for k, v in users.items() if v.get('forsale', False) == flag}
-    if start:
-        users = {k: v for k, v in users.items() if v.get('created_at', '') >= start}
-    if end:
-        users = {k: v for k, v in users.items() if v.get('created_at', '') <= end}
-    items = list(users.items())
-    # 管理员用户优先显示
-    admins = [i for i in items if i[1].get('is_admin')]
-    others = [i for i in items if not i[1].get('is_admin')]
-    others.sort(key=lambda x: x[1].get('created_at', ''), reverse=(sort != 'asc'))
-    items = admins + others
-    total = len(items)
-    page_items = items[(page - 1) * per_page: page * per_page]
+    # 多条件筛选、管理员优先排序、计数与分页均在数据库中完成
+    page_items, total = page_users(
+        page=page, per_page=per_page, descending=(sort != 'asc'), admins_first=True,
+        **user_filter_args()
+    )
     products = load_products()
     return render_template(
         'users.html', users=dict(page_items), total=total,
@@ -417,6 +390,19 @@ def user_list():
     )
 
 
+@app.route('/users/suggest')
+@admin_required
+def user_suggest():
+    """
+    用户名/昵称联想接口。
+    用途：用户列表搜索框输入时实时提示。
+    交互：返回 JSON 列表 [{username, nickname}]，走全文索引，不扫描用户表。
+    """
+    query = request.args.get('q', '').strip()
+    limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    return jsonify(suggest_users(query, limit=limit))
+
+
 @app.route('/users/add', methods=['POST'])
 @admin_required
 def add_user():
@@ -434,11 +420,8 @@ def add_user():
     product = request.form.get('product', '')
     if not username or not password:
         return redirect(url_for('user_list'))
-    users = load_users()
-    if username in users:
-        return redirect(url_for('user_list'))
-    users[username] = {
-        'user_id': generate_user_id(users),
+    created = insert_user(username, {
+        'user_id': generate_user_id(),
         'password': password,
         'nickname': nickname,
         'is_admin': is_admin,
@@ -452,11 +435,11 @@ def add_user():
         'ip_address': '',
         'location': '',
         'remark': ''
-    }
-    save_users(users)
+    })
+    if not created:
+        return redirect(url_for('user_list'))
     # ledger
-    records = load_ledger()
-    records.append({
+    add_ledger_record({
         'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'admin': session.get('admin'),
         'role': 'admin',
@@ -465,7 +448,6 @@ def add_user():
         'count': 1,
         'revenue': price
     })
-    save_ledger(records)
     return redirect(url_for('user_list'))
 
 
@@ -476,10 +458,7 @@ def delete_user(name):
     删除指定用户（管理员操作）。
     用途：用户数据清理。
     """
-    users = load_users()
-    if name in users:
-        users.pop(name)
-        save_users(users)
+    remove_user(name)
     return redirect(url_for('user_list'))
 
 
@@ -490,8 +469,7 @@ def toggle_user(name):
     用途：账号管控，支持AJAX和表单。
     安全：仅管理员horsray或代理本人可操作。
     """
-    users = load_users()
-    user = users.get(name)
+    user = get_user(name)
     permitted = False
     if session.get('admin') == 'horsray':
         permitted = True
@@ -500,8 +478,8 @@ def toggle_user(name):
     if not permitted:
         return redirect(url_for('login'))
     if user:
-        user['enabled'] = not user.get('enabled', True)
-        save_users(users)
+        # 乐观并发：基于当前版本翻转启用状态，被并发修改时自动重试
+        user = modify_user(name, lambda u: {'enabled': not u.get('enabled', True)}) or user
         if request.is_json or request.headers.get('Content-Type') == 'application/json':
             return jsonify({'success': True, 'enabled': user['enabled']})
     if request.is_json or request.headers.get('Content-Type') == 'application/json':
@@ -515,26 +493,11 @@ def mark_sold(name):
     """
     标记代理名下某账号为已售出。
     用途：代理销售记录台账。
-    交互：仅代理本人且账号处于待售状态可操作。
+    交互：仅代理本人且账号处于待售状态可操作；与批量售出共用同一条件更新，
+          待售判断、标记售出与台账记录在同一事务内，重复点击不会重复记账。
     """
-    users = load_users()
     current = session.get('agent')
-    if name in users and users[name].get('owner') == current and users[name].get('forsale'):
-        users[name]['forsale'] = False
-        save_users(users)
-        # add ledger record when item sold
-        records = load_ledger()
-        price = users[name].get('price', 0)
-        records.append({
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'admin': current,
-            'role': 'agent',
-            'product': users[name].get('product', ''),
-            'price': price,
-            'count': 1,
-            'revenue': price
-        })
-        save_ledger(records)
+    if batch_update_users('sold', [name], owner=current, sale=_agent_sale(current)):
         if request.is_json or request.headers.get('Accept') == 'application/json':
             return jsonify({'success': True})
     if request.is_json or request.headers.get('Accept') == 'application/json':
@@ -548,31 +511,25 @@ def batch_sold():
     """
     批量标记代理名下账号为已售出。
     用途：代理批量销售，台账同步记录。
+    交互：一条UPDATE标记售出，同一事务内为每个售出账号追加台账记录。
     """
     names = request.form.getlist('names')
-    users = load_users()
     current = session.get('agent')
-    sold_any = False
-    for name in names:
-        if name in users and users[name].get('owner') == current and users[name].get('forsale'):
-            users[name]['forsale'] = False
-            price = users[name].get('price', 0)
-            records = load_ledger()
-            records.append({
-                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'admin': current,
-                'role': 'agent',
-                'product': users[name].get('product', ''),
-                'price': price,
-                'count': 1,
-                'revenue': price
-            })
-            save_ledger(records)
-            sold_any = True
-    save_users(users)
+    batch_update_users('sold', names, owner=current, sale=_agent_sale(current))
     return redirect(url_for('agent_users'))
 
 
+def _agent_sale(agent: str) -> dict:
+    """
+    代理售出台账记录的公共字段（产品与价格取自各账号）。
+    """
+    return {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'admin': agent,
+        'role': 'agent',
+    }
+
+
 @app.route('/sales/users/<name>/update', methods=['POST'])
 @agent_required
 def agent_update_user(name):
@@ -581,9 +538,8 @@ def agent_update_user(name):
     用途：代理自助管理。
     安全：仅限本人；支持用户名变更、密码、昵称、产品、备注等。
     """
-    users = load_users()
     current = session.get('agent')
-    user = users.get(name)
+    user = get_user(name)
     if not user or user.get('owner') != current:
         if request.is_json:
             return jsonify({'success': False}), 404
@@ -592,8 +548,7 @@ def agent_update_user(name):
         data = request.get_json(silent=True) or {}
         remark = data.get('remark')
         if remark is not None:
-            user['remark'] = remark
-            save_users(users)
+            patch_user(name, {'remark': remark})
             return jsonify({'success': True})
         return jsonify({'success': False}), 400
     new_name = request.form.get('username')
@@ -602,20 +557,16 @@ def agent_update_user(name):
     enabled = bool(request.form.get('enabled'))
     product = request.form.get('product')
     remark = request.form.get('remark', '')
-    if new_name and new_name != name and new_name not in users:
-        users[new_name] = user
-        users.pop(name)
+    if new_name and new_name != name and rename_user(name, new_name):
         name = new_name
-        user = users[name]
+    fields = {'enabled': enabled, 'remark': remark}
     if password:
-        user['password'] = password
+        fields['password'] = password
     if nickname is not None:
-        user['nickname'] = nickname
-    user['enabled'] = enabled
+        fields['nickname'] = nickname
     if product is not None:
-        user['product'] = product
-    user['remark'] = remark
-    save_users(users)
+        fields['product'] = product
+    patch_user(name, fields)
     return redirect(url_for('agent_users'))
 
 
@@ -625,20 +576,12 @@ def batch_action():
     """
     管理员批量操作用户（删除、启用、禁用）。
     用途：多选批量管理。
+    交互：每个操作对所选用户执行一条UPDATE/DELETE。
     """
     action = request.form.get('action')
     names = request.form.getlist('names')
-    users = load_users()
-    for name in names:
-        if name not in users:
-            continue
-        if action == 'delete':
-            users.pop(name)
-        elif action == 'enable':
-            users[name]['enabled'] = True
-        elif action == 'disable':
-            users[name]['enabled'] = False
-    save_users(users)
+    if action in ('delete', 'enable', 'disable'):
+        batch_update_users(action, names)
     return redirect(url_for('user_list'))
 
 
@@ -648,33 +591,15 @@ def agent_batch_action():
     """
     代理批量操作自己名下用户（启用、禁用、标记已售）。
     用途：代理自助多选管理。
+    交互：仅作用于本人名下账号；标记已售时台账与状态在同一事务内写入。
     """
     action = request.form.get('action')
     names = request.form.getlist('names')
-    users = load_users()
     current = session.get('agent')
-    for name in names:
-        if name not in users or users[name].get('owner') != current:
-            continue
-        if action == 'enable':
-            users[name]['enabled'] = True
-        elif action == 'disable':
-            users[name]['enabled'] = False
-        elif action == 'sold' and users[name].get('forsale'):
-            users[name]['forsale'] = False
-            price = users[name].get('price', 0)
-            records = load_ledger()
-            records.append({
-                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'admin': current,
-                'role': 'agent',
-                'product': users[name].get('product', ''),
-                'price': price,
-                'count': 1,
-                'revenue': price
-            })
-            save_ledger(records)
-    save_users(users)
+    if action in ('enable', 'disable'):
+        batch_update_users(action, names, owner=current)
+    elif action == 'sold':
+        batch_update_users('sold', names, owner=current, sale=_agent_sale(current))
     return redirect(url_for('agent_users'))
 
 
@@ -685,13 +610,10 @@ def update_user(name):
     管理员更新用户信息（支持AJAX备注更新）。
     用途：支持表单与AJAX两种方式。
     """
-    users = load_users()
     if request.is_json:
         data = request.get_json(silent=True) or {}
         remark = data.get('remark')
-        if name in users and remark is not None:
-            users[name]['remark'] = remark
-            save_users(users)
+        if remark is not None and patch_user(name, {'remark': remark}) is not None:
             return jsonify({'success': True})
         return jsonify({'success': False}), 404
 
@@ -703,103 +625,290 @@ def update_user(name):
     enabled = bool(request.form.get('enabled'))
     product = request.form.get('product')
     remark = request.form.get('remark', '')
-    if name in users:
-        user = users[name]
-        if new_name and new_name != name:
-            users[new_name] = user
-            users.pop(name)
+    if get_user(name) is not None:
+        if new_name and new_name != name and rename_user(name, new_name):
             name = new_name
+        fields = {
+            'is_admin': is_admin,
+            'is_agent': is_agent,
+            'enabled': enabled,
+            'remark': remark,
+        }
         if password:
-            users[name]['password'] = password
+            fields['password'] = password
         if nickname is not None:
-            users[name]['nickname'] = nickname
-        users[name]['is_admin'] = is_admin
-        users[name]['is_agent'] = is_agent
-        users[name]['enabled'] = enabled
+            fields['nickname'] = nickname
         if product is not None:
-            users[name]['product'] = product
-        users[name]['remark'] = remark
-        save_users(users)
+            fields['product'] = product
+        patch_user(name, fields)
     return redirect(url_for('user_list'))
 
 
+# 后台任务线程池：每个进程一个，按需创建（gunicorn fork 后重新创建）
+JOB_WORKERS = 2
+# 任务心跳间隔（秒）：本进程排队/运行中的任务定期刷新 updated_at，
+# 超过 JOB_STALE_SECONDS 未刷新的任务在读取时被标记为失败
+JOB_HEARTBEAT = 15
+_job_pool = None
+_job_pool_pid = None
+_job_pool_lock = threading.Lock()
+_active_jobs = set()
+
+
+def _get_job_pool() -> ThreadPoolExecutor:
+    """
+    获取当前进程的后台任务线程池（首次创建时同时启动心跳线程）。
+    """
+    global _job_pool, _job_pool_pid
+    with _job_pool_lock:
+        if _job_pool is None or _job_pool_pid != os.getpid():
+            _job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+            _job_pool_pid = os.getpid()
+            # fork 继承的任务属于父进程
+            _active_jobs.clear()
+            threading.Thread(target=_job_heartbeat, name='job-heartbeat', daemon=True).start()
+        return _job_pool
+
+
+def _job_heartbeat() -> None:
+    """
+    心跳线程：定期刷新本进程任务的 updated_at，证明任务进程仍在运行。
+    """
+    while True:
+        time.sleep(JOB_HEARTBEAT)
+        with _job_pool_lock:
+            job_ids = list(_active_jobs)
+        try:
+            touch_jobs(job_ids)
+        except Exception:
+            pass
+
+
+def _run_job(job_id: str, func, args: tuple) -> None:
+    """
+    在线程池中执行任务函数，并把状态、结果、异常写回任务表。
+    """
+    try:
+        update_job(job_id, status='running')
+        try:
+            result = func(job_id, *args)
+        except Exception as exc:
+            update_job(job_id, status='failed', error=str(exc))
+        else:
+            update_job(job_id, status='done', result=result)
+    finally:
+        with _job_pool_lock:
+            _active_jobs.discard(job_id)
+
+
+def submit_job(kind: str, func, *args, owner=None, params=None, total: int = 0) -> str:
+    """
+    提交后台任务。
+    参数:
+        func: 任务函数，签名 func(job_id, *args)，返回值作为结果存入任务表；
+              可调用 update_job(job_id, done=...) 上报进度。
+    返回:
+        任务ID，页面可通过 /jobs/<id> 查看进度与结果。
+    """
+    job_id = create_job(kind, owner=owner, params=params, total=total)
+    pool = _get_job_pool()
+    with _job_pool_lock:
+        _active_jobs.add(job_id)
+    pool.submit(_run_job, job_id, func, args)
+    return job_id
+
+
+# 导入参数：每批写入行数
+IMPORT_CHUNK_ROWS = 1000
+
+
+def _iter_import_rows(ws):
+    """
+    逐行解析只读工作表（不整表载入内存）。
+    返回:
+        生成器，产出 (行号, 用户名, 密码, 昵称, 是否管理员)，已跳过表头与空行。
+    """
+    for num, row in enumerate(ws.iter_rows(min_row=2, values_only=True), 2):
+        if not row or all(v is None or str(v).strip() == '' for v in row):
+            continue
+        username = str(row[0]).strip() if row[0] is not None else ''
+        password = str(row[1]) if len(row) > 1 and row[1] is not None else ''
+        nickname = str(row[2]) if len(row) > 2 and row[2] is not None else ''
+        is_admin = bool(row[3]) if len(row) > 3 else False
+        yield num, username, password, nickname, is_admin
+
+
+def run_import(job_id: str, path: str, price: float, product: str, admin, dry_run: bool) -> dict:
+    """
+    执行一次用户导入：校验、分批事务写入、记录被拒绝的行与进度。
+    参数:
+        dry_run: 仅校验并统计新建/覆盖数量，不写入用户与台账。
+    返回:
+        结果汇总 {'created', 'updated', 'rejected', 'dry_run'}，由任务线程池写入任务记录。
+    交互：每 IMPORT_CHUNK_ROWS 行一个事务，单批失败不影响已提交的批次。
+    """
+    wb = None
+    seen = set()
+    summary = {'created': 0, 'updated': 0, 'rejected': 0, 'dry_run': dry_run}
+    processed = 0
+    chunk, rejects = {}, []
+
+    def flush():
+        existing = existing_usernames(list(chunk))
+        summary['updated'] += len(existing)
+        summary['created'] += len(chunk) - len(existing)
+        if not dry_run and chunk:
+            create_users(chunk, overwrite=True)
+        add_job_rejects(job_id, rejects)
+        summary['rejected'] += len(rejects)
+        update_job(job_id, done=processed)
+        chunk.clear()
+        rejects.clear()
+
+    try:
+        wb = load_workbook(path, read_only=True)
+        ws = wb.active
+        update_job(job_id, total=max((ws.max_row or 1) - 1, 0))
+        for num, username, password, nickname, is_admin in _iter_import_rows(ws):
+            processed += 1
+            if not username or not password:
+                rejects.append((num, username, '缺少用户名或密码'))
+            elif username in seen:
+                rejects.append((num, username, '文件内用户名重复'))
+            else:
+                seen.add(username)
+                chunk[username] = {
+                    'password': password,
+                    'nickname': nickname,
+                    'is_admin': is_admin,
+                    'enabled': True,
+                    'source': 'import',
+                    'product': product,
+                    'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'last_login': None,
+                    'price': price,
+                    'ip_address': '',
+                    'location': ''
+                }
+            if len(chunk) + len(rejects) >= IMPORT_CHUNK_ROWS:
+                flush()
+        flush()
+        count = summary['created'] + summary['updated']
+        if not dry_run and count > 0 and price > 0:
+            add_ledger_record({
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'admin': admin,
+                'role': 'admin',
+                'product': product,
+                'price': price,
+                'count': count,
+                'revenue': price * count
+            })
+        update_job(job_id, done=processed, total=processed)
+    except Exception:
+        # 已提交的批次保留，记录失败前的统计
+        update_job(job_id, done=processed, result=summary)
+        raise
+    finally:
+        if wb is not None:
+            wb.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return summary
+
+
 @app.route('/users/import', methods=['POST'])
 @admin_required
 def import_users():
     """
     批量导入用户（Excel）。
-    用途：大批量账号导入。
-    交互：导入成功自动写入台账。
+    用途：大批量账号导入，支持仅校验（dry_run）。
+    交互：上传文件暂存后交给后台任务流式解析，页面轮询进度；
+          导入成功自动写入台账，被拒绝的行可下载报告。
     """
     file = request.files.get('file')
     price = float(request.form.get('price') or 0)
     product = request.form.get('product', '')
+    dry_run = bool(request.form.get('dry_run'))
     if not file:
         return redirect(url_for('user_list'))
     filename = secure_filename(file.filename)
     if not filename:
         return redirect(url_for('user_list'))
-    wb = load_workbook(file)
-    ws = wb.active
-    users = load_users()
-    first = True
-    count = 0
-    for row in ws.iter_rows(values_only=True):
-        if first:
-            first = False
-            continue
-        username = str(row[0]) if row and row[0] else None
-        password = str(row[1]) if row and len(row) > 1 else None
-        nickname = str(row[2]) if row and len(row) > 2 else ''
-        is_admin = bool(row[3]) if row and len(row) > 3 else False
-        if username and password:
-            users[username] = {
-                'user_id': generate_user_id(users),
-                'password': password,
-                'nickname': nickname,
-                'is_admin': is_admin,
-                'enabled': True,
-                'source': 'import',
-                'product': product,
-                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'last_login': None,
-                'price': price,
-                'ip_address': '',
-                'location': ''
-            }
-            count += 1
-    save_users(users)
-    if count > 0 and price > 0:
-        records = load_ledger()
-        records.append({
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'admin': session.get('admin'),
-            'role': 'admin',
-            'product': product,
-            'price': price,
-            'count': count,
-            'revenue': price * count
-        })
-        save_ledger(records)
-    return redirect(url_for('user_list'))
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    with os.fdopen(fd, 'wb') as f:
+        file.save(f)
+    # 请求内不解析工作表，行数由任务开始时读取
+    job_id = submit_job(
+        'import', run_import, path, price, product, session.get('admin'), dry_run,
+        owner=session.get('admin'),
+        params={'file': filename, 'price': price, 'product': product, 'dry_run': dry_run}
+    )
+    return redirect(url_for('job_view', job_id=job_id))
+
+
+@app.route('/jobs')
+@admin_required
+def job_list():
+    """
+    后台任务列表页：最近的导入、批量开通、批量审批任务。
+    """
+    return render_template('jobs.html', jobs=list_jobs())
+
+
+@app.route('/jobs/<job_id>')
+@admin_required
+def job_view(job_id):
+    """
+    任务详情页：显示进度与结果，运行中自动轮询状态。
+    """
+    job = get_job(job_id)
+    if not job:
+        return redirect(url_for('user_list'))
+    return render_template('job.html', job=job)
+
+
+@app.route('/jobs/<job_id>/status')
+@admin_required
+def job_status(job_id):
+    """
+    任务状态接口（JSON），供页面轮询进度。
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'not_found'}), 404
+    # 只返回进度字段：结果（批次号、统计等）由任务页面渲染；批量开通的账号在 bulk_accounts 表中按批次分页
+    return jsonify({k: job[k] for k in ('id', 'kind', 'status', 'done', 'total', 'error')})
+
+
+@app.route('/jobs/<job_id>/rejects')
+@admin_required
+def job_rejects(job_id):
+    """
+    下载任务中被拒绝行的报告（CSV：行号、用户名、原因）。
+    """
+    return stream_csv(f'rejects_{job_id}.csv', ['行号', '用户名', '原因'], iter_job_rejects(job_id))
+
+
+# 用户导出表头
+USER_EXPORT_HEADER = [
+    '用户编号', '用户名', '密码', '昵称', '是否管理员',
+    '启用', '来源', '创建时间', '最后登录', '产品', 'IP地址', '位置'
+]
 
 
 @app.route('/users/export')
 @admin_required
 def export_users():
     """
-    导出所有用户信息为Excel文件。
+    导出用户信息为Excel文件（format=csv 时导出CSV）。
     用途：管理员备份、分析。
+    交互：支持与用户列表相同的筛选与排序参数，数据库游标逐行输出，不整表载入内存。
     """
-    users = load_users()
-    wb = Workbook()
-    ws = wb.active
-    ws.append([
-        '用户编号', '用户名', '密码', '昵称', '是否管理员',
-        '启用', '来源', '创建时间', '最后登录', '产品', 'IP地址', '位置'
-    ])
-    for name, info in users.items():
-        ws.append([
+    rows = (
+        [
             info.get('user_id', ''),
             name,
             info.get('password'),
@@ -809,14 +918,18 @@ def export_users():
             info.get('source'),
             info.get('created_at'),
             info.get('last_login'),
-            info.get('product',''),
+            info.get('product', ''),
             info.get('ip_address', ''),
             info.get('location', '')
-        ])
-    bio = BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return send_file(bio, download_name='users_export.xlsx', as_attachment=True)
+        ]
+        for name, info in iter_users(
+            descending=(request.args.get('sort', 'desc') != 'asc'), admins_first=True,
+            **user_filter_args()
+        )
+    )
+    if request.args.get('format') == 'csv':
+        return stream_csv('users_export.csv', USER_EXPORT_HEADER, rows)
+    return send_xlsx('users_export.xlsx', USER_EXPORT_HEADER, rows)
 
 
 @app.route('/users/template')
@@ -911,54 +1024,83 @@ def bulk_create():
     """
     批量创建随机新用户。
     用途：管理员大批量生成账号。
-    交互：会话保存本次批量信息，写入台账。
+    交互：提交后台任务，会话只保存任务ID；批量页面显示进度与结果。
     """
     count = int(request.form.get('count', 0))
     price = float(request.form.get('price') or 0)
     product = request.form.get('product', '')
-    users = load_users()
-    new_accounts = []
-    for _ in range(count):
-        while True:
-            uname = f"huiying{os.urandom(4).hex()}"[:12]
-            if uname not in users:
-                break
-        pwd = os.urandom(4).hex()
-        users[uname] = {
-            'user_id': generate_user_id(users),
-            'password': pwd,
-            'nickname': '',
-            'is_admin': False,
-            'enabled': True,
-            'source': 'batch',
-            'product': product,
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'last_login': None,
-            'price': price,
-            'ip_address': '',
-            'location': ''
-        }
-        new_accounts.append({'username': uname, 'password': pwd})
-    save_users(users)
-    session['bulk_accounts'] = new_accounts
-    session['bulk_info'] = {
+    admin = session.get('admin')
+    session['bulk_job'] = submit_job(
+        'bulk', run_bulk_create, count, price, product, admin,
+        owner=admin, params={'count': count, 'price': price, 'product': product}, total=count
+    )
+    return redirect(url_for('bulk_manage'))
+
+
+# 批量开通：每批生成的账号数（每批一个事务，账号与该批台账一起提交）
+BULK_CHUNK_ACCOUNTS = 5000
+
+
+def run_bulk_create(job_id: str, count: int, price: float, product: str, admin) -> dict:
+    """
+    后台任务：批量生成随机账号并写入台账。
+    账号列表以任务ID为批次号保存在服务端，供批量页面分页与导出。
+    交互：每 BULK_CHUNK_ACCOUNTS 个账号一个事务，账号与对应台账记录同时提交，
+          每批提交后更新任务进度；中途失败时已提交的账号均已入账。
+    返回:
+        {'batch': 批次号, 'count': 账号数, 'info': {product, price, admin, time}}
+    """
+    template = {
+        'nickname': '',
+        'is_admin': False,
+        'enabled': True,
+        'source': 'batch',
         'product': product,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'last_login': None,
         'price': price,
-        'admin': session.get('admin'),
-        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        'ip_address': '',
+        'location': ''
     }
-    if count > 0 and price > 0:
-        records = load_ledger()
-        records.append({
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'admin': session.get('admin'),
+    created = 0
+    while created < count:
+        n = min(BULK_CHUNK_ACCOUNTS, count - created)
+        ledger = None
+        if price > 0:
+            ledger = {
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'admin': admin,
+                'product': product,
+                'price': price,
+                'count': n,
+                'revenue': price * n
+            }
+        created += len(create_generated_users(
+            n, template, random_credentials, batch_id=job_id, first_seq=created, ledger=ledger
+        ))
+        update_job(job_id, done=created)
+    return {
+        'batch': job_id,
+        'count': created,
+        'info': {
             'product': product,
             'price': price,
-            'count': count,
-            'revenue': price * count
-        })
-        save_ledger(records)
-    return redirect(url_for('bulk_manage'))
+            'admin': admin,
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    }
+
+
+def revenue_summary(role, admin=None, product=None) -> tuple:
+    """
+    读取今日、本月、本年及累计收入。
+    用途：台账页面统计卡片。
+    交互：一次查询预聚合汇总表（ledger_rollup），不扫描台账记录。
+    """
+    now = datetime.now()
+    periods = (now.strftime('%Y-%m-%d'), now.strftime('%Y-%m'), now.strftime('%Y'), '')
+    sums = ledger_rollup(periods, role=role, admin=admin, product=product)
+    return tuple(sums[p] for p in periods)
 
 
 @app.route('/ledger')
@@ -969,45 +1111,19 @@ def ledger_view():
     用途：显示收入统计、筛选、导出。
     交互：仅统计role=admin的记录，避免重复计算。
     """
-    records = load_ledger()
     product_filter = request.args.get('product', '')
     admin_filter = request.args.get('admin', '')
     start = request.args.get('start', '')
     end = request.args.get('end', '')
     
-    # 过滤记录
-    # Only show admin role records to avoid counting agent sales
-    filtered_records = [r for r in records if r.get('role') == 'admin']
-    if product_filter:
-        filtered_records = [r for r in filtered_records if r.get('product') == product_filter]
-    if admin_filter:
-        filtered_records = [r for r in filtered_records if r.get('admin') == admin_filter]
-    if start:
-        filtered_records = [r for r in filtered_records if r.get('time', '') >= start]
-    if end:
-        filtered_records = [r for r in filtered_records if r.get('time', '') <= end]
-    
-    # 计算统计数据
-    from datetime import datetime
-    today = datetime.now().strftime('%Y-%m-%d')
-    this_month = datetime.now().strftime('%Y-%m')
-    this_year = datetime.now().strftime('%Y')
-    
-    # 计算各时间段收入
-    daily = sum(
-        r.get('revenue', 0) for r in records
-        if r.get('role') == 'admin' and r.get('time', '').startswith(today)
-    )
-    monthly = sum(
-        r.get('revenue', 0) for r in records
-        if r.get('role') == 'admin' and r.get('time', '').startswith(this_month)
+    # 过滤记录（仅role=admin，避免重复计算代理销售），走台账表索引
+    filtered_records = query_ledger(
+        role='admin', product=product_filter, admin=admin_filter, start=start, end=end
     )
-    yearly = sum(
-        r.get('revenue', 0) for r in records
-        if r.get('role') == 'admin' and r.get('time', '').startswith(this_year)
-    )
-    total = sum(r.get('revenue', 0) for r in records if r.get('role') == 'admin')
-    
+
+    # 计算统计数据：直接读取预聚合的收入汇总
+    daily, monthly, yearly, total = revenue_summary(role='admin')
+
     products = load_products()
     return render_template(
         'ledger.html', records=filtered_records,
@@ -1017,6 +1133,17 @@ def ledger_view():
     )
 
 
+@app.route('/sales/users/suggest')
+@agent_required
+def agent_user_suggest():
+    """
+    代理名下用户联想接口，仅返回当前代理的用户。
+    """
+    query = request.args.get('q', '').strip()
+    limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    return jsonify(suggest_users(query, limit=limit, owner=session.get('agent')))
+
+
 @app.route('/sales/users')
 @agent_required
 def agent_users():
@@ -1024,9 +1151,7 @@ def agent_users():
     代理名下用户管理页面。
     用途：代理自助筛选、分页、排序、管理账号。
     """
-    users = load_users()
     current = session.get('agent')
-    my_users = {k: v for k, v in users.items() if v.get('owner') == current}
 
     query = request.args.get('q', '')
     sale = request.args.get('sale', '')
@@ -1037,23 +1162,12 @@ def agent_users():
     page = int(request.args.get('page', 1))
     per_page = max(int(request.args.get('per_page', 20)), 1)
 
-    if query:
-        my_users = {k: v for k, v in my_users.items() if query.lower() in k.lower()}
-    if status:
-        flag = status == 'enabled'
-        my_users = {k: v for k, v in my_users.items() if v.get('enabled', True) == flag}
-    if sale:
-        flag = sale == 'forsale'
-        my_users = {k: v for k, v in my_users.items() if v.get('forsale', False) == flag}
-    if start:
-        my_users = {k: v for k, v in my_users.items() if v.get('created_at', '') >= start}
-    if end:
-        my_users = {k: v for k, v in my_users.items() if v.get('created_at', '') <= end}
-
-    items = list(my_users.items())
-    items.sort(key=lambda x: x[1].get('created_at', ''), reverse=(sort != 'asc'))
-    total = len(items)
-    page_items = items[(page - 1) * per_page: page * per_page]
+    page_items, total = page_users(
+        page=page, per_page=per_page, descending=(sort != 'asc'),
+        owner=current, q=query, start=start, end=end,
+        enabled=(status == 'enabled') if status else None,
+        forsale=(sale == 'forsale') if sale else None,
+    )
 
     return render_template(
         'users.html',
@@ -1083,26 +1197,22 @@ def agent_ledger():
     start = request.args.get('start', '')
     end = request.args.get('end', '')
 
-    records = [
-        r for r in load_ledger()
-        if r.get('admin') == session.get('agent') and r.get('role') == 'agent'
-    ]
-    if product_filter:
-        records = [r for r in records if r.get('product') == product_filter]
-    if start:
-        records = [r for r in records if r.get('time', '') >= start]
-    if end:
-        records = [r for r in records if r.get('time', '') <= end]
-
-    from datetime import datetime
-    today = datetime.now().strftime('%Y-%m-%d')
-    this_month = datetime.now().strftime('%Y-%m')
-    this_year = datetime.now().strftime('%Y')
-
-    daily = sum(r.get('revenue', 0) for r in records if r.get('time', '').startswith(today))
-    monthly = sum(r.get('revenue', 0) for r in records if r.get('time', '').startswith(this_month))
-    yearly = sum(r.get('revenue', 0) for r in records if r.get('time', '').startswith(this_year))
-    total = sum(r.get('revenue', 0) for r in records)
+    filters = dict(
+        role='agent', admin=session.get('agent'), product=product_filter, start=start, end=end
+    )
+    records = query_ledger(**filters)
+
+    if start or end:
+        # 任意日期区间无法用汇总表回答，按时间索引范围求和
+        now = datetime.now()
+        daily = ledger_revenue(now.strftime('%Y-%m-%d'), **filters)
+        monthly = ledger_revenue(now.strftime('%Y-%m'), **filters)
+        yearly = ledger_revenue(now.strftime('%Y'), **filters)
+        total = ledger_revenue(**filters)
+    else:
+        daily, monthly, yearly, total = revenue_summary(
+            role='agent', admin=session.get('agent'), product=product_filter
+        )
 
     products = load_products()
     return render_template(
@@ -1119,16 +1229,14 @@ def apply_bulk():
     """
     代理批量申请账号页面。
     用途：提交申请，显示申请历史。
-    交互：写入applications.json，session标记提交成功。
+    交互：写入申请表，session标记提交成功。
     """
     products = load_products()
     if request.method == 'POST':
         count = int(request.form.get('count', 0))
         price = float(request.form.get('price') or 0)
         product = request.form.get('product', '')
-        apps = load_applications()
-        apps.append({
-            'id': os.urandom(6).hex(),
+        create_application({
             'agent': session.get('agent'),
             'count': count,
             'price': price,
@@ -1136,11 +1244,10 @@ def apply_bulk():
             'status': 'pending',
             'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
-        save_applications(apps)
         session['apply_success'] = True
         return redirect(url_for('apply_bulk'))
     success = session.pop('apply_success', False)
-    my_apps = [a for a in load_applications() if a.get('agent') == session.get('agent')]
+    my_apps = list_applications(agent=session.get('agent'))
     return render_template(
         'bulk.html', accounts=None, products=products, info=None,
         page=1, per_page=20, total=0, success=success, apps=my_apps
@@ -1153,54 +1260,72 @@ def applications_list():
     """
     管理员审批页面，显示所有代理批量申请。
     """
-    apps = load_applications()
-    return render_template('applications.html', apps=apps, products=load_products())
-
-
-def _approve_application(app_record):
-    """
-    内部函数：审批通过代理批量申请，批量生成账号并写入台账。
-    用途：供审批接口调用。
-    """
-    users = load_users()
-    new_accounts = []
-    for _ in range(app_record['count']):
-        while True:
-            uname = f"huiying{os.urandom(4).hex()}"[:12]
-            if uname not in users:
-                break
-        pwd = os.urandom(4).hex()
-        users[uname] = {
-            'user_id': generate_user_id(users),
-            'password': pwd,
-            'nickname': '',
-            'is_admin': False,
-            'enabled': True,
-            'source': 'agent',
-            'product': app_record['product'],
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'last_login': None,
-            'price': app_record['price'],
-            'ip_address': '',
-            'location': '',
-            'owner': app_record['agent'],
-            'forsale': True
-        }
-        new_accounts.append({'username': uname, 'password': pwd})
-    save_users(users)
-    records = load_ledger()
-    records.append({
-        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'admin': session.get('admin'),
+    apps = list_applications()
+    results = session.pop('app_results', None)
+    return render_template(
+        'applications.html', apps=apps, products=load_products(), results=results
+    )
+
+
+def _application_build(app_record, admin):
+    """
+    内部函数：生成审批通过后的账号模板与台账记录。
+    用途：供批量审批引擎按申请逐条调用。
+    """
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    template = {
+        'nickname': '',
+        'is_admin': False,
+        'enabled': True,
+        'source': 'agent',
+        'product': app_record['product'],
+        'created_at': now,
+        'last_login': None,
+        'price': app_record['price'],
+        'ip_address': '',
+        'location': '',
+        'owner': app_record['agent'],
+        'forsale': True
+    }
+    ledger = {
+        'time': now,
+        'admin': admin,
         'agent': app_record['agent'],
         'role': 'admin',
         'product': app_record['product'],
         'price': app_record['price'],
         'count': app_record['count'],
         'revenue': app_record['price'] * app_record['count']
-    })
-    save_ledger(records)
-    app_record['status'] = 'approved'
+    }
+    return template, ledger
+
+
+def _summarize_app_results(results: dict) -> dict:
+    """
+    内部函数：汇总逐条审批结果，供审批页与任务页提示。
+    用途：只保留计数和前若干条未处理的申请（cookie 容量有限）。
+    """
+    summary = {'approved': 0, 'rejected': 0, 'accounts': 0, 'skipped': []}
+    for app_id, result in results.items():
+        if result['result'] in ('approved', 'rejected'):
+            summary[result['result']] += 1
+            summary['accounts'] += result.get('accounts', 0)
+        elif len(summary['skipped']) < 20:
+            summary['skipped'].append([app_id, result['result'], result.get('status', '')])
+    return summary
+
+
+def run_approve_applications(job_id: str, ids: list, admin) -> dict:
+    """
+    后台任务：在一个事务内审批通过多条申请（批量建号、写台账、改状态）。
+    返回:
+        审批结果汇总。
+    """
+    results = approve_applications(
+        ids, random_credentials, lambda app_record: _application_build(app_record, admin)
+    )
+    update_job(job_id, done=len(ids))
+    return _summarize_app_results(results)
 
 
 @app.route('/applications/<app_id>/approve', methods=['POST'])
@@ -1210,12 +1335,11 @@ def approve_application(app_id):
     审批通过指定代理批量申请。
     用途：管理员操作。
     """
-    apps = load_applications()
-    app_record = next((a for a in apps if a['id'] == app_id), None)
-    if not app_record or app_record['status'] != 'pending':
-        return redirect(url_for('applications_list'))
-    _approve_application(app_record)
-    save_applications(apps)
+    admin = session.get('admin')
+    results = approve_applications(
+        [app_id], random_credentials, lambda app_record: _application_build(app_record, admin)
+    )
+    session['app_results'] = _summarize_app_results(results)
     return redirect(url_for('applications_list'))
 
 
@@ -1226,12 +1350,7 @@ def reject_application(app_id):
     拒绝指定代理批量申请。
     用途：管理员操作。
     """
-    apps = load_applications()
-    for a in apps:
-        if a['id'] == app_id and a['status'] == 'pending':
-            a['status'] = 'rejected'
-            break
-    save_applications(apps)
+    session['app_results'] = _summarize_app_results(reject_applications([app_id]))
     return redirect(url_for('applications_list'))
 
 
@@ -1242,14 +1361,15 @@ def update_application(app_id):
     更新指定申请的数量、单价、产品。
     用途：管理员审批前可修正申请内容。
     """
-    apps = load_applications()
-    app_record = next((a for a in apps if a['id'] == app_id), None)
-    if not app_record or app_record.get('status') != 'pending':
-        return redirect(url_for('applications_list'))
-    app_record['count'] = int(request.form.get('count', app_record['count']))
-    app_record['price'] = float(request.form.get('price', app_record['price']))
-    app_record['product'] = request.form.get('product', app_record['product'])
-    save_applications(apps)
+    fields = {}
+    if request.form.get('count'):
+        fields['count'] = int(request.form['count'])
+    if request.form.get('price'):
+        fields['price'] = float(request.form['price'])
+    if request.form.get('product'):
+        fields['product'] = request.form['product']
+    # 仅待审批状态的申请会被修改
+    patch_application(app_id, fields)
     return redirect(url_for('applications_list'))
 
 
@@ -1262,18 +1382,15 @@ def batch_applications():
     """
     action = request.form.get('action')
     ids = request.form.getlist('ids')
-    if action == 'approve':
-        apps = load_applications()
-        for app_record in apps:
-            if app_record['id'] in ids and app_record['status'] == 'pending':
-                _approve_application(app_record)
-        save_applications(apps)
+    if action == 'approve' and ids:
+        # 所有选中申请的建号、台账、状态更新在后台任务的同一事务内集合式完成
+        job_id = submit_job(
+            'approve', run_approve_applications, ids, session.get('admin'),
+            owner=session.get('admin'), params={'ids': ids}, total=len(ids)
+        )
+        return redirect(url_for('job_view', job_id=job_id))
     elif action == 'reject':
-        apps = load_applications()
-        for a in apps:
-            if a['id'] in ids and a['status'] == 'pending':
-                a['status'] = 'rejected'
-        save_applications(apps)
+        session['app_results'] = _summarize_app_results(reject_applications(ids))
     return redirect(url_for('applications_list'))
 
 
@@ -1282,6 +1399,21 @@ if __name__ == '__main__':
     # 主程序入口，支持命令行指定端口
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=5001, help='Port to run the server on')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='Recompute ledger revenue rollups from the ledger and exit')
+    parser.add_argument('--rebuild-search', action='store_true',
+                        help='Rebuild the user search index (run after VACUUM) and exit')
+    parser.add_argument('--build-ipdb', metavar='CSV',
+                        help='Build the local IP range file from CSV (start,end,location...) and exit')
     args = parser.parse_args()
+    if args.rebuild_rollups:
+        rebuild_ledger_rollups()
+        raise SystemExit(0)
+    if args.rebuild_search:
+        rebuild_user_search()
+        raise SystemExit(0)
+    if args.build_ipdb:
+        print(f'{build_ip_database(args.build_ipdb)} ranges written to {IP_DB_PATH}')
+        raise SystemExit(0)
     app.run(host='0.0.0.0', port=args.port, debug=True)
 
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def executing(prompt_id, node):
+    return {"type": "executing", "data": {"prompt_id": prompt_id, "node": node}}
+
+
+def progress(prompt_id, value):
+    return {"type": "progress", "data": {"prompt_id": prompt_id, "value": value}}
+
+
+class ClientLogTest(unittest.TestCase):
+
+    def types(self, log):
+        return [(e["data"]["type"], e["data"]["data"].get("node", e["data"]["data"].get("value")))
+                for e in log.entries]
+
+    def test_running_updates_coalesce(self):
+        log = main.ClientLog()
+        for node in range(5):
+            log.append(executing("P", node))
+            log.append(progress("P", node))
+        self.assertEqual(self.types(log), [("executing", 4), ("progress", 4)])
+
+    def test_terminal_survives_later_executing(self):
+        # 结束事件之后同一 prompt 的 executing/progress 不能把它取代掉
+        log = main.ClientLog()
+        log.append(executing("P", 3))
+        log.append(executing("P", None))
+        log.append(executing("P", 5))
+        log.append(progress("P", 5))
+        self.assertIn(("executing", None), self.types(log))
+        messages, lost, reset = log.read(0)
+        self.assertEqual([m["data"]["data"]["node"] for m in messages if m["data"]["type"] == "executing"],
+                         [None, 5])
+        self.assertEqual(lost, 0)
+
+    def test_terminal_survives_flood(self):
+        log = main.ClientLog(size=5, terminal_size=3)
+        log.append({"type": "execution_success", "data": {"prompt_id": "P"}})
+        for i in range(50):
+            log.append({"type": "status", "data": {"i": i}})
+        self.assertEqual(log.entries[0]["data"]["type"], "execution_success")
+        self.assertEqual(len(log), 6)
+
+    def test_prompt_finished(self):
+        main.client_logs.pop("t-client", None)
+        main.add_message_to_queue("t-client", executing("P", 2))
+        self.assertFalse(main.prompt_finished("t-client", "P"))
+        main.add_message_to_queue("t-client", executing("P", None))
+        self.assertTrue(main.prompt_finished("t-client", "P"))
+        main.client_logs.pop("t-client", None)
+
+
+if __name__ == "__main__":
+    unittest.main()